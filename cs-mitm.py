@@ -2,6 +2,7 @@
 # mitmproxy script to intercept, decrypt and inject commands into Cobalt Strike beacon network traffic
 
 import binascii
+import collections
 import Crypto.PublicKey.RSA
 import Crypto.Cipher.PKCS1_v1_5
 import Crypto.Cipher.AES
@@ -9,8 +10,83 @@ import hashlib
 import hmac
 import struct
 import time
+import threading
+import asyncio
+import concurrent.futures
+import optparse
+import os
+import sys
+import queue
+import http.server
+import json
+import random
+import tempfile
+import shutil
+import sqlite3
+import re
+import base64
+import codecs
+import urllib.parse
 
 CS_FIXED_IV = b'abcdefghijklmnop'
+CS_FIXED_IV_INTEGER = int.from_bytes(CS_FIXED_IV, 'big')
+KEYSTORE_MAXIMUM_FINGERPRINTS = 10000
+KEYSTORE_MAXIMUM_FAILURES = 10000
+KEYSTORE_FAILURES_TTL = 3600
+KEYSTORE_POLL_INTERVAL = 5
+KEYSTORE_SCRIPT_SOURCE = '<script>' # source of the keys in dKeys, that are not removed by changes of key files
+SESSIONS_MAXIMUM = 10000
+SESSIONS_IDLE_TIMEOUT = 24 * 3600
+SESSIONSTORE_INTERVAL = 1.0
+SESSIONSTORE_BATCH = 1000
+RSA_WORKERS = 0 # 0 = RSA decryption in the event loop
+RSA_QUEUE_MAXIMUM = 64
+REPLAY_CHUNK = 1000
+EVENTLOG_ERROR = 0
+EVENTLOG_INFO = 1
+EVENTLOG_DEBUG = 2
+EVENTLOG_CONTENT = 3 # includes hex dumps of the flow content
+EVENTLOG_LEVEL = EVENTLOG_INFO
+EVENTLOG_BATCH = 1000
+EVENTLOG_QUEUE = 100000
+EVENTLOG_MAXIMUM_SIZE = 100 * 1024 * 1024
+EVENTLOG_ROTATIONS = 5
+EVENTLOG_STDERR = '<stderr>' # event log filename for stderr, used for the diagnostics of the standalone commands
+HISTOGRAM_SUB_BITS = 5 # relative precision of the latency histograms: 1 / 2^(HISTOGRAM_SUB_BITS - 1)
+METRICS_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+METRICS_INTERVAL = 10
+METRICS_PENDING_MAXIMUM = 10000
+CALLBACK_CHUNK = 0x10000 # multiple of the AES block size
+
+# check-in number (or * for check-ins without rule) followed by a task: sleep milliseconds [jitter], exit, task number [hexarguments]
+SCHEDULER_RULES = '''
+1 sleep 5000 0
+2 exit
+'''
+
+# malleable C2 profile used when no profiles are loaded: metadata BASE64 encoded in the Cookie header, bid in the id parameter
+PROFILE = '''
+http-get {
+    set uri "/match";
+    client {
+        metadata {
+            base64;
+            header "Cookie";
+        }
+    }
+}
+http-post {
+    set uri "/submit.php";
+    client {
+        id {
+            parameter "id";
+        }
+        output {
+            print;
+        }
+    }
+}
+'''
 
 dKeys = {
     "30819f300d06092a864886f70d010101050003818d003081890281810080fa8dc59ec39b73d49523c640c1cdfabbb0f0b15e943f2429c0c360862c938fb474523a0116f2ea71877f24218fc85cd959017cd0f987ec443a731a4d29a7a8fe1312d2edace8a736515d120c8f7b5e0008b7403ee3511435367f223c474ec2c0913c1dede6c1124b5089dc2aec3ef37ce24009a590ef4b8398f52e75c1f2ed020301000100000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000": "30820275020100300d06092a864886f70d01010105000482025f3082025b0201000281810080fa8dc59ec39b73d49523c640c1cdfabbb0f0b15e943f2429c0c360862c938fb474523a0116f2ea71877f24218fc85cd959017cd0f987ec443a731a4d29a7a8fe1312d2edace8a736515d120c8f7b5e0008b7403ee3511435367f223c474ec2c0913c1dede6c1124b5089dc2aec3ef37ce24009a590ef4b8398f52e75c1f2ed02030100010281800d789de81f1df515930584b8073976c7126577ae3edfa2fca6f3c0344baf4a363f35cb04cdea54b2d1eac207c70d9a72c02cc0b005af9a57be0490d3156e1d59ac7837c74987a296671f4264781050d39ccc16f5f5024699fe6f3aad9b77e874117e213b369ef6c58c43a4423585db42eb022251914f3110b52532620fe82dad024100f6c00bf6a8e14566029cfdfef39a77c50511056f235a0dc71b46c5d5b17b6494c290496a3d76635d5ae21f615bc5e04e2a2a2001957fec6b3ce88c0ca9a36aaf02410085d04e59788f32150b4039fc0140fa06a66181cb463cdec2d573111e8904fd4aadffa63e8f2f2063c7e212bef5981c1ed2ff6f1163a04662d483067658ceb32302403b44035b9a528935a83906f4be9402626b061c95061bb2257992b51fcf8240b54e4a13a815dd229ea09ea144e42311ee14488be9757c054ff8902e5b383f8cf702407fcd78d74926f2bd58968a0adf23b0e8a30623d2028e666f8d2fae1d0cdec010106947dd1e21f37c794eb97abad4019f8b043d8f4d28a9b100a8f78616c1ac2302403e247b8970b1e457b2c82759d3427a24edfa7d309a4a619ebfcab16cb2593a67564fe7c4d68b73958f856831e9fe1d4ba2ec4281234a2a903b4b07a50084b3d5",
@@ -24,19 +100,285 @@ dKeys = {
     "30819f300d06092a864886f70d010101050003818d0030818902818100b22ee1f895f1d872618c1090316c5f5be9488c11056503b8c77fc2969850fe63f6fcd32708e8a5e49095c04526d73a509a46c4351640ce94598a4005d9b0af3b454e0b572002f524f88c34b5d3fbe2ec6508b7dbd6528b340d7fa6bf9a4529635e97845e0329b343b3e6d290665cc3fe852ac135524e7c0a08ab6830a0b01057020301000100000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000": "30820277020100300d06092a864886f70d0101010500048202613082025d02010002818100b22ee1f895f1d872618c1090316c5f5be9488c11056503b8c77fc2969850fe63f6fcd32708e8a5e49095c04526d73a509a46c4351640ce94598a4005d9b0af3b454e0b572002f524f88c34b5d3fbe2ec6508b7dbd6528b340d7fa6bf9a4529635e97845e0329b343b3e6d290665cc3fe852ac135524e7c0a08ab6830a0b01057020301000102818100a664f3af21cf9c528c57b16c064b6eedb4f7839dad8cfca1c4e3c142c2f0f7ef404a2fa14747830be41d8454cf85b4366b2be4b4b2984891eee01513a18bc6c6a1c6d21895cc26039f6acbcaa985d2aa08cf5b2155bebf0f4305f960f0d2b123ac6827d932170b7651a26f618ec72b0fd246e9c8ff9528fa95533a3b168b74e9024100e6b53acbc441cbc411b8815c9d959971356e8088477519524e0bf3d77d6d8b71e86d765b72042acb0e590ee1c7ffddaa9c63ed69592e615067c89c72247ac925024100c5b78e39f3553142982f9b730ebc230a641ae2302bc2218e8c82da19e6bdddf0cd756f340c161aa6a11bbbb59ec3fe3aa7cccdf30b5ff9bb2dd6d4919a6b50cb024100e0888b439bab498c768eb26018026c0711308da9949a33ddb595ce68f06ab7e751858f466a8e01b4042fcadb1512418375978f8d133d9f7a68b7870353dba87d024002ec60dcf87d14fa6017ac1bba670bb9969b5326d52ecca237efa35be8ae7bfe987b1906d2faecaff407ddf1a4844f58fcac298b636aaadd9aa2e787b399cc9b02406a5e97f4947b15e3b7feb6160b85228686d0099f3e99938dfd9535b09951b97d35bb6870789ae31f67794be4e2f7919d104e0610346ee7f174580e0da81cf3db"
 }
 
-def RSADecrypt(key, data):
-    oPrivateKey = Crypto.PublicKey.RSA.importKey(binascii.a2b_hex(key))
-    oRSAPrivateKey = Crypto.Cipher.PKCS1_v1_5.new(oPrivateKey)
-    ciphertext = data
+def RSADecryptCipher(oRSAPrivateKey, data):
     try:
-        cleartext = oRSAPrivateKey.decrypt(ciphertext, None)
+        cleartext = oRSAPrivateKey.decrypt(data, None)
     except ValueError:
         return None
     if cleartext == b'':
-        return None   
+        return None
     return cleartext
 
+# private key: hexadecimal DER or PEM
+def ImportPrivateKey(key):
+    if key.lstrip().startswith('-----BEGIN'):
+        return Crypto.PublicKey.RSA.importKey(key)
+    return Crypto.PublicKey.RSA.importKey(binascii.a2b_hex(key))
+
+def RSADecrypt(key, data):
+    oPrivateKey = ImportPrivateKey(key)
+    oRSAPrivateKey = Crypto.Cipher.PKCS1_v1_5.new(oPrivateKey)
+    return RSADecryptCipher(oRSAPrivateKey, data)
+
+def IsHexadecimalDER(value):
+    return len(value) % 2 == 0 and re.fullmatch('(?i)30[0-9a-f]+', value) != None
+
+# key files: .pem (one private key, identified by its filename), .json (dictionary public key: private key)
+# or text files with a public and private key (hexadecimal DER) per line, other lines are ignored
+def ReadKeyFile(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.pem':
+        with open(filename, 'r') as fKeys:
+            return {os.path.basename(filename): fKeys.read()}
+    elif extension == '.json':
+        with open(filename, 'r') as fKeys:
+            dKeysFile = json.load(fKeys)
+        if not isinstance(dKeysFile, dict) or not all([isinstance(publicKey, str) and isinstance(privateKey, str) for publicKey, privateKey in dKeysFile.items()]):
+            raise ValueError('JSON key file is not a dictionary of public key: private key strings')
+        return dKeysFile
+    dKeysFile = {}
+    with open(filename, 'r') as fKeys:
+        for line in fKeys:
+            tokens = line.split('#')[0].replace(':', ' ').replace(',', ' ').split()
+            if len(tokens) == 2 and IsHexadecimalDER(tokens[0]) and IsHexadecimalDER(tokens[1]):
+                dKeysFile[tokens[0]] = tokens[1]
+    return dKeysFile
+
+# parses each private key once, at first use, and keeps the PKCS1 cipher objects for all check-ins
+# keys can be loaded from a key file or directory, that is polled for changes (mtime) every pollInterval seconds
+# keys are tried in adaptive order: last successful key first, then by number of hits
+# metadata blobs already decrypted are remembered by their SHA-256 digest
+# metadata blobs that no key can decrypt are remembered too (LRU + TTL), and are only retried with keys added later
+class cKeyStore(object):
+
+    def __init__(self, dKeys, maximumFingerprints=KEYSTORE_MAXIMUM_FINGERPRINTS, maximumFailures=KEYSTORE_MAXIMUM_FAILURES, failuresTTL=KEYSTORE_FAILURES_TTL, pollInterval=KEYSTORE_POLL_INTERVAL):
+        self.dPrivateKeys = {}
+        self.dCiphers = {}
+        self.dHits = {}
+        self.keyOrder = []
+        self.keysAdded = []
+        self.dFingerprints = collections.OrderedDict()
+        self.maximumFingerprints = maximumFingerprints
+        self.dFailures = collections.OrderedDict()
+        self.maximumFailures = maximumFailures
+        self.failuresTTL = failuresTTL
+        self.path = ''
+        self.dSources = {KEYSTORE_SCRIPT_SOURCE: [None, set(dKeys.keys())]}
+        self.filenamesMissing = set()
+        self.pollInterval = pollInterval
+        self.nextPoll = 0.0
+        self.oLock = threading.Lock()
+        self.oParseLock = threading.Lock()
+        self.countParses = 0
+        self.countParsesAvoided = 0
+        self.countLookups = 0
+        self.countFingerprintHits = 0
+        self.countRSAAttempts = 0
+        self.countFailures = 0
+        self.countSkipped = 0
+        for publicKey, privateKey in dKeys.items():
+            self.AddKey(publicKey, privateKey, lazy=True)
+
+    def AddKey(self, publicKey, privateKey, lazy=False):
+        with self.oLock:
+            if not publicKey in self.dPrivateKeys:
+                self.keyOrder.append(publicKey)
+                self.dHits[publicKey] = 0
+            self.dPrivateKeys[publicKey] = privateKey
+            self.dCiphers.pop(publicKey, None)
+            self.keysAdded.append(publicKey)
+        if not lazy:
+            self.Cipher(publicKey)
+
+    def RemoveKey(self, publicKey):
+        with self.oLock:
+            if publicKey in self.dPrivateKeys:
+                del self.dPrivateKeys[publicKey]
+                del self.dHits[publicKey]
+                self.dCiphers.pop(publicKey, None)
+                self.keyOrder.remove(publicKey)
+
+    # returns None for a key that was removed, or that can not be parsed (it is then removed, and logged)
+    # parsing is serialized by oParseLock, so that worker threads do not parse the same key twice
+    def Cipher(self, publicKey):
+        oRSAPrivateKey = self.dCiphers.get(publicKey)
+        if oRSAPrivateKey != None:
+            return oRSAPrivateKey
+        with self.oParseLock:
+            oRSAPrivateKey = self.dCiphers.get(publicKey)
+            if oRSAPrivateKey != None:
+                return oRSAPrivateKey
+            privateKey = self.dPrivateKeys.get(publicKey)
+            if privateKey == None:
+                return None
+            try:
+                oRSAPrivateKey = Crypto.Cipher.PKCS1_v1_5.new(ImportPrivateKey(privateKey))
+            except (ValueError, IndexError, TypeError) as e:
+                oEventLog.Event(EVENTLOG_ERROR, 'error', publickey=hashlib.sha256(publicKey.encode()).hexdigest(), error='private key: %s' % e)
+                self.RemoveKey(publicKey)
+                return None
+            with self.oLock:
+                self.dCiphers[publicKey] = oRSAPrivateKey
+                self.countParses += 1
+        return oRSAPrivateKey
+
+    def Load(self, path):
+        self.path = path
+        self.filenamesMissing = set()
+        self.Poll(force=True)
+
+    def Poll(self, force=False):
+        now = time.time()
+        if self.path == '' or not force and now < self.nextPoll:
+            return
+        self.nextPoll = now + self.pollInterval
+        if os.path.isdir(self.path):
+            filenames = [oEntry.path for oEntry in os.scandir(self.path) if oEntry.is_file()]
+        else:
+            filenames = [self.path]
+        dMtimes = {}
+        # a key file or directory that does not exist is logged once, until it exists again
+        for filename in filenames:
+            try:
+                dMtimes[filename] = os.stat(filename).st_mtime_ns
+                self.filenamesMissing.discard(filename)
+            except OSError as e:
+                if not filename in self.filenamesMissing:
+                    self.filenamesMissing.add(filename)
+                    oEventLog.Event(EVENTLOG_ERROR, 'error', filename=filename, error='key file: %s' % e)
+        for filename in list(self.dSources.keys()):
+            if filename != KEYSTORE_SCRIPT_SOURCE and not filename in dMtimes:
+                self.UpdateSource(filename, None, {})
+        for filename, mtime in dMtimes.items():
+            if self.dSources.get(filename, [None])[0] != mtime:
+                try:
+                    dKeysFile = ReadKeyFile(filename)
+                except (OSError, ValueError) as e:
+                    oEventLog.Event(EVENTLOG_ERROR, 'error', filename=filename, error='key file: %s' % e)
+                    continue
+                self.UpdateSource(filename, mtime, dKeysFile)
+
+    def UpdateSource(self, filename, mtime, dKeysFile):
+        publicKeysOld = self.dSources.get(filename, [None, set()])[1]
+        if mtime == None:
+            del self.dSources[filename]
+        else:
+            self.dSources[filename] = [mtime, set(dKeysFile.keys())]
+        publicKeysOtherSources = set()
+        for mtimeSource, publicKeys in self.dSources.values():
+            publicKeysOtherSources.update(publicKeys)
+        for publicKey in publicKeysOld - publicKeysOtherSources:
+            self.RemoveKey(publicKey)
+        for publicKey, privateKey in dKeysFile.items():
+            if self.dPrivateKeys.get(publicKey) != privateKey:
+                self.AddKey(publicKey, privateKey, lazy=True)
+        oEventLog.Event(EVENTLOG_INFO, 'keys', filename=filename, keys=len(dKeysFile), total=len(self.dPrivateKeys))
+
+    def Hit(self, publicKey):
+        self.dHits[publicKey] += 1
+        self.keyOrder.remove(publicKey)
+        self.keyOrder.sort(key=lambda item: self.dHits[item], reverse=True)
+        self.keyOrder.insert(0, publicKey)
+
+    # returns [result, countKeysTried]: result is a cached [publicKey, decryptedMetadata] (or [None, None] for a known failure)
+    # countKeysTried is not None for a failure that has to be retried with the keys added since
+    def Cached(self, fingerprint):
+        with self.oLock:
+            self.countLookups += 1
+            if fingerprint in self.dFingerprints:
+                self.dFingerprints.move_to_end(fingerprint)
+                self.countFingerprintHits += 1
+                return [self.dFingerprints[fingerprint], None]
+            if fingerprint in self.dFailures:
+                expiry, countKeysTried = self.dFailures[fingerprint]
+                if expiry < time.time():
+                    del self.dFailures[fingerprint]
+                elif countKeysTried == len(self.keysAdded):
+                    self.dFailures.move_to_end(fingerprint)
+                    self.countSkipped += 1
+                    return [[None, None], None]
+                else:
+                    return [None, countKeysTried]
+            return [None, None]
+
+    # the RSA operations are done without holding the lock, so that several threads can decrypt in parallel
+    # the key order is taken when the decryption starts, to profit from hits of decryptions that ran before
+    def TryKeys(self, data, fingerprint, countKeysTried):
+        with self.oLock:
+            if countKeysTried == None:
+                keyOrder = list(self.keyOrder)
+            else:
+                keyOrder = self.keysAdded[countKeysTried:]
+            countKeys = len(self.keysAdded)
+        for publicKey in keyOrder:
+            # a parse is avoided when the key was already parsed by a previous attempt
+            parsed = publicKey in self.dCiphers
+            oRSAPrivateKey = self.Cipher(publicKey)
+            if oRSAPrivateKey == None:
+                continue
+            decryptedMetadata = RSADecryptCipher(oRSAPrivateKey, data)
+            with self.oLock:
+                self.countRSAAttempts += 1
+                if parsed:
+                    self.countParsesAvoided += 1
+                if decryptedMetadata != None:
+                    if publicKey in self.dHits:
+                        self.Hit(publicKey)
+                    self.dFailures.pop(fingerprint, None)
+                    self.dFingerprints[fingerprint] = [publicKey, decryptedMetadata]
+                    if len(self.dFingerprints) > self.maximumFingerprints:
+                        self.dFingerprints.popitem(last=False)
+                    return [publicKey, decryptedMetadata]
+        with self.oLock:
+            self.countFailures += 1
+            if fingerprint in self.dFailures:
+                self.dFailures[fingerprint][1] = countKeys
+                self.dFailures.move_to_end(fingerprint)
+            else:
+                self.dFailures[fingerprint] = [time.time() + self.failuresTTL, countKeys]
+                if len(self.dFailures) > self.maximumFailures:
+                    self.dFailures.popitem(last=False)
+        return [None, None]
+
+    def AddFingerprint(self, fingerprint, result):
+        with self.oLock:
+            self.dFingerprints[fingerprint] = result
+            if len(self.dFingerprints) > self.maximumFingerprints:
+                self.dFingerprints.popitem(last=False)
+
+    def DecryptMetadata(self, data):
+        fingerprint = hashlib.sha256(data).digest()
+        result, countKeysTried = self.Cached(fingerprint)
+        if result != None:
+            return result
+        return self.TryKeys(data, fingerprint, countKeysTried)
+
+    def Statistics(self):
+        with self.oLock:
+            return self.StatisticsUnlocked()
+
+    def StatisticsUnlocked(self):
+        if self.countLookups == 0:
+            averageRSAAttempts = 0.0
+        else:
+            averageRSAAttempts = self.countRSAAttempts / float(self.countLookups)
+        return {
+            'lookups': self.countLookups,
+            'fingerprinthits': self.countFingerprintHits,
+            'fingerprintmisses': self.countLookups - self.countFingerprintHits,
+            'failures': self.countFailures,
+            'skipped': self.countSkipped,
+            'rsaattempts': self.countRSAAttempts,
+            'averagersaattempts': averageRSAAttempts,
+            'parses': self.countParses,
+            'parsesavoided': self.countParsesAvoided,
+            'keys': len(self.dPrivateKeys),
+            'keyhits': dict(self.dHits),
+        }
+
 
+# the HMAC key is hashed once into a template HMAC object that is copied for each message
+# the AES-CBC cipher objects are created once and reused: the chaining value left by the previous message (its last ciphertext block) is cancelled by XORing it, together with the fixed IV, into the first block
 class cCrypto(object):
 
     def __init__(self, rawkey='', hmacaeskeys=''):
@@ -52,24 +394,101 @@ class cCrypto(object):
         else:
             self.hmackey = None
             self.aeskey = None
+        self.oHMAC = None
+        self.oEncryptor = None
+        self.chainEncrypt = CS_FIXED_IV_INTEGER
+        self.oDecryptor = None
+        self.chainDecrypt = CS_FIXED_IV_INTEGER
+        self.oLock = threading.Lock()
+
+    def HMAC(self, data):
+        if self.oHMAC == None:
+            self.oHMAC = hmac.new(self.hmackey, digestmod=hashlib.sha256)
+        oHMAC = self.oHMAC.copy()
+        oHMAC.update(data)
+        return oHMAC.digest()[:16]
 
     def Decrypt(self, data):
         if self.aeskey == None:
             return data
         encryptedData = data[:-16]
         hmacSignatureMessage = data[-16:]
-        hmacsSgnatureCalculated = hmac.new(self.hmackey, encryptedData, hashlib.sha256).digest()[:16]
+        hmacsSgnatureCalculated = self.HMAC(encryptedData)
         if hmacSignatureMessage != hmacsSgnatureCalculated:
             raise Exception('HMAC signature invalid')
+        if len(encryptedData) == 0:
+            return b''
+        if len(encryptedData) % 16 != 0:
+            raise Exception('Encrypted data size is not a multiple of 16')
+        with self.oLock:
+            if self.oDecryptor == None:
+                self.oDecryptor = Crypto.Cipher.AES.new(self.aeskey, Crypto.Cipher.AES.MODE_CBC, CS_FIXED_IV)
+            decryptedData = bytearray(self.oDecryptor.decrypt(encryptedData))
+            decryptedData[:16] = (int.from_bytes(decryptedData[:16], 'big') ^ CS_FIXED_IV_INTEGER ^ self.chainDecrypt).to_bytes(16, 'big')
+            self.chainDecrypt = int.from_bytes(encryptedData[-16:], 'big')
+        return bytes(decryptedData)
+
+    # output: optional preallocated buffer of len(data) + 16 bytes, the encrypted data + HMAC are written to it and it is returned as a memoryview
+    def Encrypt(self, data, output=None):
+        size = len(data)
+        if size % 16 != 0:
+            raise ValueError('Data must be padded to 16 byte boundary in CBC mode')
+        if output == None:
+            buffer = memoryview(bytearray(size + 16))
+        else:
+            buffer = memoryview(output)
+        encryptedData = buffer[:size]
+        if size > 0:
+            encryptedData[:] = data
+            with self.oLock:
+                if self.oEncryptor == None:
+                    self.oEncryptor = Crypto.Cipher.AES.new(self.aeskey, Crypto.Cipher.AES.MODE_CBC, CS_FIXED_IV)
+                encryptedData[:16] = (int.from_bytes(data[:16], 'big') ^ CS_FIXED_IV_INTEGER ^ self.chainEncrypt).to_bytes(16, 'big')
+                self.oEncryptor.encrypt(encryptedData, output=encryptedData)
+                self.chainEncrypt = int.from_bytes(encryptedData[-16:], 'big')
+        buffer[size:] = self.HMAC(encryptedData)
+        if output == None:
+            return bytes(buffer)
+        return buffer
+
+    # the same (packaged) data encrypted for many sessions, into one preallocated buffer; returns a memoryview (encrypted data + HMAC) per cCrypto object
+    @staticmethod
+    def EncryptBatch(cryptos, data):
+        size = len(data) + 16
+        buffer = memoryview(bytearray(size * len(cryptos)))
+        return [oCrypto.Encrypt(data, buffer[index * size:(index + 1) * size]) for index, oCrypto in enumerate(cryptos)]
+
+    # verifies the HMAC and decrypts chunk by chunk into a preallocated buffer, without copying the (large) input; returns a memoryview
+    def DecryptChunked(self, data, chunkSize=CALLBACK_CHUNK):
+        data = memoryview(data)
+        encryptedData = data[:-16]
+        hmacSignatureMessage = bytes(data[-16:])
+        if self.oHMAC == None:
+            self.oHMAC = hmac.new(self.hmackey, digestmod=hashlib.sha256)
+        oHMAC = self.oHMAC.copy()
+        for position in range(0, len(encryptedData), chunkSize):
+            oHMAC.update(encryptedData[position:position + chunkSize])
+        if hmacSignatureMessage != oHMAC.digest()[:16]:
+            raise Exception('HMAC signature invalid')
+        if len(encryptedData) % 16 != 0:
+            raise Exception('Encrypted data size is not a multiple of 16')
+        decryptedData = memoryview(bytearray(len(encryptedData)))
         cypher = Crypto.Cipher.AES.new(self.aeskey, Crypto.Cipher.AES.MODE_CBC, CS_FIXED_IV)
-        decryptedData = cypher.decrypt(encryptedData)
+        for position in range(0, len(encryptedData), chunkSize):
+            cypher.decrypt(encryptedData[position:position + chunkSize], output=decryptedData[position:position + chunkSize])
         return decryptedData
 
-    def Encrypt(self, data):
-        cypher = Crypto.Cipher.AES.new(self.aeskey, Crypto.Cipher.AES.MODE_CBC, CS_FIXED_IV)
-        encryptedData = cypher.encrypt(data)
-        hmacsSgnatureCalculated = hmac.new(self.hmackey, encryptedData, hashlib.sha256).digest()[:16]
-        return encryptedData + hmacsSgnatureCalculated
+# callback data posted by a beacon: one or more packets length (4 bytes) + encrypted data + HMAC
+# decrypted packet: counter (4 bytes) + size (4 bytes) + callback type (4 bytes) + callback data (size - 4 bytes)
+def ParseCallbacks(oCrypto, data):
+    data = memoryview(data)
+    position = 0
+    while position + 4 <= len(data):
+        length = struct.unpack_from('>I', data, position)[0]
+        decrypted = oCrypto.DecryptChunked(data[position + 4:position + 4 + length])
+        position += 4 + length
+        counter, size, callback = struct.unpack_from('>III', decrypted, 0)
+        yield {'counter': counter, 'callback': callback, 'data': decrypted[12:8 + size]}
 
 class cTask(object):
     def __init__(self):
@@ -82,11 +501,22 @@ class cTask(object):
             return data
         return data + b'A' * (modulo - remainder)
 
+    @staticmethod
+    def Command(taskNumber, arguments=b''):
+        return struct.pack('>II', taskNumber, len(arguments)) + arguments
+
+    # several commands are packaged in one task response, built in one buffer: timestamp, size, commands, padding
+    @staticmethod
+    def PackageCommands(commands):
+        size = sum([len(command) for command in commands])
+        data = bytearray(b'A' * ((8 + size + 15) // 16 * 16))
+        struct.pack_into('>II', data, 0, int(time.time()), size)
+        data[8:8 + size] = b''.join(commands)
+        return bytes(data)
+
     @staticmethod
     def Package(taskNumber, arguments=b''):
-        command = struct.pack('>II', taskNumber, len(arguments)) + arguments
-        data = struct.pack('>II', int(time.time()), len(command)) + command
-        return __class__.PadToMultiple(data, 16)
+        return __class__.PackageCommands([__class__.Command(taskNumber, arguments)])
 
     def Exit(self):
         return __class__.Package(3)
@@ -94,38 +524,1228 @@ class cTask(object):
     def Sleep(self, milliseconds, jitter):
         return __class__.Package(4, struct.pack('>II', milliseconds, jitter))
 
-dRawkeys = {}
+def ParseMetadata(decryptedMetadata):
+    dMetadata = {'rawkey': binascii.b2a_hex(decryptedMetadata[8:8 + 16]).decode()}
+    try:
+        dMetadata['bid'], dMetadata['pid'], dMetadata['port'], dMetadata['flags'] = struct.unpack('>IIHB', decryptedMetadata[28:39])
+        dMetadata['info'] = decryptedMetadata[59:].rstrip(b'\x00').decode('latin-1').split('\t')
+    except struct.error:
+        pass
+    return dMetadata
+
+def ParseTasks(decryptedTasks):
+    tasks = []
+    timestamp, length = struct.unpack('>II', decryptedTasks[:8])
+    position = 8
+    while position + 8 <= 8 + length:
+        command, argumentsLength = struct.unpack('>II', decryptedTasks[position:position + 8])
+        tasks.append({'command': command, 'arguments': binascii.b2a_hex(decryptedTasks[position + 8:position + 8 + argumentsLength]).decode()})
+        position += 8 + argumentsLength
+    return [timestamp, tasks]
+
+def SplitCommands(data):
+    commands = []
+    position = 0
+    while position + 8 <= len(data):
+        length = struct.unpack('>I', data[position + 4:position + 8])[0]
+        commands.append(data[position:position + 8 + length])
+        position += 8 + length
+    return commands
+
+class cSession(object):
+
+    # hmacaeskeys: derived keys (hmac:aes in hexadecimal), when restoring a session
+    def __init__(self, rawkey, hmacaeskeys=''):
+        self.rawkey = rawkey
+        if hmacaeskeys == '':
+            self.oCrypto = cCrypto(rawkey=binascii.b2a_hex(rawkey))
+        else:
+            self.oCrypto = cCrypto(hmacaeskeys=hmacaeskeys)
+        self.bid = None
+        self.checkins = 0
+        self.lastSeen = time.time()
+        self.tasks = collections.deque()
+        self.broadcasts = 0
+        self.lastTasks = []
+        self.fingerprint = None
+        self.publicKey = None
+        self.metadata = None
+
+# beacon sessions keyed by raw key, least recently seen first
+# idle sessions are evicted by age and by count, to keep memory bounded
+class cSessions(object):
+
+    def __init__(self, maximum=SESSIONS_MAXIMUM, idleTimeout=SESSIONS_IDLE_TIMEOUT):
+        self.dSessions = collections.OrderedDict()
+        self.dBids = {}
+        self.maximum = maximum
+        self.idleTimeout = idleTimeout
+        self.countEvicted = 0
+        self.timesKeyDerivation = oMetrics.Stage('keyderivation')
+
+    def Evict(self, now):
+        while len(self.dSessions) > 0:
+            oSession = next(iter(self.dSessions.values()))
+            if len(self.dSessions) <= self.maximum and oSession.lastSeen + self.idleTimeout >= now:
+                break
+            self.dSessions.popitem(last=False)
+            if self.dBids.get(oSession.bid) == oSession.rawkey:
+                del self.dBids[oSession.bid]
+            self.countEvicted += 1
+
+    def Checkin(self, rawkey, bid=None):
+        now = time.time()
+        oSession = self.dSessions.get(rawkey)
+        if oSession == None:
+            start = time.perf_counter()
+            oSession = cSession(rawkey)
+            self.timesKeyDerivation.append(time.perf_counter() - start)
+            self.dSessions[rawkey] = oSession
+        else:
+            self.dSessions.move_to_end(rawkey)
+        oSession.checkins += 1
+        oSession.lastSeen = now
+        if bid != None:
+            oSession.bid = bid
+            self.dBids[bid] = rawkey
+        self.Evict(now)
+        return oSession
+
+    def Lookup(self, bid):
+        return self.dSessions.get(self.dBids.get(bid))
+
+    def Restore(self, oSession):
+        self.dSessions[oSession.rawkey] = oSession
+        if oSession.bid != None:
+            self.dBids[oSession.bid] = oSession.rawkey
+
+    def __len__(self):
+        return len(self.dSessions)
+
+# sessions persisted in a SQLite database (WAL mode): the sessions in memory are the read path, the database is write-behind
+# Save queues the state of a session, a background thread writes queued states in batches; sessions idle for longer than idleTimeout are deleted
+class cSessionStore(object):
+
+    def __init__(self, idleTimeout=SESSIONS_IDLE_TIMEOUT, interval=SESSIONSTORE_INTERVAL, batch=SESSIONSTORE_BATCH):
+        self.filename = ''
+        self.oConnection = None
+        self.idleTimeout = idleTimeout
+        self.interval = interval
+        self.batch = batch
+        self.dPending = {}
+        self.oLock = threading.Lock()
+        self.oWake = threading.Event()
+        self.oThread = None
+        self.stop = False
+        self.countWrites = 0
+
+    def Open(self, filename):
+        self.Close()
+        self.filename = filename
+        if filename == '':
+            return
+        self.oConnection = sqlite3.connect(filename, check_same_thread=False)
+        self.oConnection.execute('PRAGMA journal_mode=WAL')
+        self.oConnection.execute('PRAGMA synchronous=NORMAL')
+        self.oConnection.execute('CREATE TABLE IF NOT EXISTS sessions (rawkey BLOB PRIMARY KEY, fingerprint BLOB, publickey TEXT, metadata BLOB, hmacaeskeys TEXT, bid INTEGER, checkins INTEGER, lastseen REAL, lasttasks BLOB)')
+        self.oConnection.commit()
+        self.Load()
+        self.stop = False
+        self.oThread = threading.Thread(target=self.Writer, name='cs-mitm-sessionstore', daemon=True)
+        self.oThread.start()
+
+    def Load(self):
+        count = 0
+        for rawkey, fingerprint, publicKey, metadata, hmacaeskeys, bid, checkins, lastSeen, lastTasks in self.oConnection.execute('SELECT rawkey, fingerprint, publickey, metadata, hmacaeskeys, bid, checkins, lastseen, lasttasks FROM sessions WHERE lastseen >= ? ORDER BY lastseen', (time.time() - self.idleTimeout, )):
+            oSession = cSession(rawkey, hmacaeskeys)
+            oSession.bid = bid
+            oSession.checkins = checkins
+            oSession.lastSeen = lastSeen
+            oSession.lastTasks = SplitCommands(lastTasks)
+            oSession.fingerprint = fingerprint
+            oSession.publicKey = publicKey
+            oSession.metadata = metadata
+            oSessions.Restore(oSession)
+            if fingerprint != None and metadata != None:
+                oKeyStore.AddFingerprint(fingerprint, [publicKey, metadata])
+            count += 1
+        oEventLog.Event(EVENTLOG_INFO, 'sessions', filename=self.filename, restored=count)
+
+    def Save(self, oSession):
+        if self.oConnection == None:
+            return
+        row = (oSession.rawkey, oSession.fingerprint, oSession.publicKey, oSession.metadata, '%s:%s' % (binascii.b2a_hex(oSession.oCrypto.hmackey).decode(), binascii.b2a_hex(oSession.oCrypto.aeskey).decode()), oSession.bid, oSession.checkins, oSession.lastSeen, b''.join(oSession.lastTasks))
+        with self.oLock:
+            self.dPending[oSession.rawkey] = row
+            if len(self.dPending) >= self.batch:
+                self.oWake.set()
+
+    def Flush(self):
+        with self.oLock:
+            rows = list(self.dPending.values())
+            self.dPending = {}
+        if rows != []:
+            self.oConnection.executemany('INSERT OR REPLACE INTO sessions (rawkey, fingerprint, publickey, metadata, hmacaeskeys, bid, checkins, lastseen, lasttasks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.oConnection.execute('DELETE FROM sessions WHERE lastseen < ?', (time.time() - self.idleTimeout, ))
+            self.oConnection.commit()
+            self.countWrites += len(rows)
+
+    def Writer(self):
+        while not self.stop:
+            self.oWake.wait(self.interval)
+            self.oWake.clear()
+            try:
+                self.Flush()
+            except sqlite3.Error as e:
+                oEventLog.Event(EVENTLOG_ERROR, 'error', filename=self.filename, error='session store: %s' % e)
+
+    def Close(self):
+        if self.oThread != None:
+            self.stop = True
+            self.oWake.set()
+            self.oThread.join()
+            self.oThread = None
+        if self.oConnection != None:
+            self.Flush()
+            self.oConnection.close()
+            self.oConnection = None
+
+# decides which commands are sent to a beacon at each check-in:
+# the rule for the check-in number, the broadcasts not yet sent to the beacon, and the commands queued for the beacon
+class cScheduler(object):
+
+    def __init__(self, rules=SCHEDULER_RULES):
+        self.dRules = {}
+        self.defaultCommands = []
+        self.broadcasts = []
+        self.LoadRules(rules)
+
+    @staticmethod
+    def ParseCommand(tokens):
+        name = tokens[0].lower()
+        if name == 'exit':
+            return cTask.Command(3)
+        elif name == 'sleep':
+            return cTask.Command(4, struct.pack('>II', int(tokens[1]), int(tokens[2]) if len(tokens) > 2 else 0))
+        elif name == 'task':
+            return cTask.Command(int(tokens[1], 0), binascii.a2b_hex(tokens[2]) if len(tokens) > 2 else b'')
+        raise Exception('Unknown task: %s' % name)
+
+    def LoadRules(self, rules):
+        dRules = {}
+        defaultCommands = []
+        for line in rules.splitlines():
+            line = line.split('#')[0].strip()
+            if line == '':
+                continue
+            tokens = line.split()
+            command = self.ParseCommand(tokens[1:])
+            if tokens[0] == '*':
+                defaultCommands.append(command)
+            else:
+                dRules.setdefault(int(tokens[0]), []).append(command)
+        self.dRules = dRules
+        self.defaultCommands = defaultCommands
+
+    def LoadRulesFile(self, filename):
+        with open(filename, 'r') as fRules:
+            self.LoadRules(fRules.read())
+
+    def Queue(self, bid, command):
+        oSession = oSessions.Lookup(bid)
+        if oSession == None:
+            return False
+        oSession.tasks.append(command)
+        return True
+
+    def Broadcast(self, command):
+        self.broadcasts.append(command)
+
+    def Tasks(self, oSession):
+        commands = list(self.dRules.get(oSession.checkins, self.defaultCommands))
+        commands.extend(self.broadcasts[oSession.broadcasts:])
+        oSession.broadcasts = len(self.broadcasts)
+        while len(oSession.tasks) > 0:
+            commands.append(oSession.tasks.popleft())
+        oSession.lastTasks = commands
+        return commands
+
+# tokens of a malleable C2 profile: [True, bytes] for strings, [False, str] for words and punctuation
+def ProfileTokens(text):
+    tokens = []
+    for oMatch in re.finditer(r'#[^\n]*|"((?:[^"\\]|\\.)*)"|([{};])|([^\s{};"#]+)', text):
+        if oMatch.group(1) != None:
+            tokens.append([True, codecs.escape_decode(oMatch.group(1).encode('utf-8'))[0]])
+        elif oMatch.group(2) != None:
+            tokens.append([False, oMatch.group(2)])
+        elif oMatch.group(3) != None:
+            tokens.append([False, oMatch.group(3)])
+    return tokens
+
+# statements are [name, arguments, block], block is None for statements terminated by ;
+def ParseProfileBlock(tokens, position):
+    statements = []
+    while position < len(tokens) and tokens[position] != [False, '}']:
+        words = []
+        while position < len(tokens) and not tokens[position] in [[False, ';'], [False, '{'], [False, '}']]:
+            words.append(tokens[position][1])
+            position += 1
+        if words == [] or position == len(tokens):
+            raise Exception('profile: unexpected end of statement')
+        block = None
+        if tokens[position] == [False, '{']:
+            block, position = ParseProfileBlock(tokens, position + 1)
+            if position == len(tokens):
+                raise Exception('profile: missing }')
+        elif tokens[position] == [False, '}']:
+            raise Exception('profile: missing ;')
+        statements.append([words[0], words[1:], block])
+        position += 1
+    return statements, position
+
+def ParseProfile(text):
+    tokens = ProfileTokens(text)
+    statements, position = ParseProfileBlock(tokens, 0)
+    if position != len(tokens):
+        raise Exception('profile: unexpected }')
+    return statements
+
+def ProfileStatement(block, name):
+    for statement in block or []:
+        if statement[0] == name:
+            return statement
+    return None
+
+def ProfileSetting(block, name, default=''):
+    for statementName, arguments, statementBlock in block or []:
+        if statementName == 'set' and len(arguments) == 2 and arguments[0] == name:
+            return arguments[1].decode('latin-1')
+    return default
+
+PROFILE_NETBIOS_DECODE = bytes.maketrans(b'abcdefghijklmnop', b'0123456789abcdef')
+PROFILE_NETBIOSU_DECODE = bytes.maketrans(b'ABCDEFGHIJKLMNOP', b'0123456789abcdef')
+PROFILE_NETBIOS_ENCODE = bytes.maketrans(b'0123456789abcdef', b'abcdefghijklmnop')
+PROFILE_NETBIOSU_ENCODE = bytes.maketrans(b'0123456789abcdef', b'ABCDEFGHIJKLMNOP')
+
+def ProfileMask(key, data):
+    stream = (key * (len(data) // 4 + 1))[:len(data)]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
+
+# data transform of a profile (metadata, id, output): statements applied in order to encode, terminated by where the data is stored
+class cProfileTransform(object):
+
+    TERMINATORS = ['header', 'parameter', 'uri-append', 'print']
+
+    def __init__(self, block):
+        self.transforms = []
+        self.terminator = None
+        for name, arguments, statementBlock in block:
+            if name in ['base64', 'base64url', 'netbios', 'netbiosu', 'mask']:
+                self.transforms.append([name, None])
+            elif name in ['prepend', 'append'] and len(arguments) == 1:
+                self.transforms.append([name, arguments[0]])
+            elif name in self.TERMINATORS:
+                self.terminator = [name, arguments[0].decode('latin-1') if len(arguments) > 0 else None]
+            else:
+                raise Exception('profile: unknown transform statement: %s' % name)
+        if self.terminator == None:
+            raise Exception('profile: transform without termination statement')
+
+    def Extract(self, request, uri):
+        name, argument = self.terminator
+        if name == 'header':
+            value = request.headers.get(argument)
+        elif name == 'parameter':
+            value = request.query.get(argument)
+        elif name == 'uri-append':
+            value = request.path.split('?', 1)[0][len(uri):]
+        else:
+            return request.raw_content
+        if value == None:
+            return None
+        return value.encode('latin-1')
+
+    def Decode(self, data):
+        for name, argument in reversed(self.transforms):
+            if name == 'base64':
+                data = binascii.a2b_base64(data)
+            elif name == 'base64url':
+                data = base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+            elif name == 'netbios':
+                data = bytes.fromhex(data.translate(PROFILE_NETBIOS_DECODE).decode('latin-1'))
+            elif name == 'netbiosu':
+                data = bytes.fromhex(data.translate(PROFILE_NETBIOSU_DECODE).decode('latin-1'))
+            elif name == 'mask':
+                data = ProfileMask(data[:4], data[4:])
+            elif name == 'prepend':
+                if not data.startswith(argument):
+                    raise ValueError('profile: prepend not found')
+                data = data[len(argument):]
+            elif name == 'append':
+                if not data.endswith(argument):
+                    raise ValueError('profile: append not found')
+                data = data[:len(data) - len(argument)]
+        return data
+
+    def Encode(self, data):
+        for name, argument in self.transforms:
+            if name == 'base64':
+                data = binascii.b2a_base64(data, newline=False)
+            elif name == 'base64url':
+                data = base64.urlsafe_b64encode(data).rstrip(b'=')
+            elif name == 'netbios':
+                data = data.hex().encode().translate(PROFILE_NETBIOS_ENCODE)
+            elif name == 'netbiosu':
+                data = data.hex().encode().translate(PROFILE_NETBIOSU_ENCODE)
+            elif name == 'mask':
+                key = os.urandom(4)
+                data = key + ProfileMask(key, data)
+            elif name == 'prepend':
+                data = argument + data
+            elif name == 'append':
+                data = data + argument
+        return data
+
+# an http-get or http-post block (including variants) of a malleable C2 profile
+# http-get: transform is the metadata transform, output the server output transform (tasks)
+# http-post: transform is the id transform, output the client output transform (callbacks)
+class cProfileTransaction(object):
+
+    def __init__(self, profile, kind, variant, block):
+        self.profile = profile
+        self.kind = kind
+        self.variant = variant
+        self.verb = ProfileSetting(block, 'verb', 'GET' if kind == 'http-get' else 'POST')
+        self.uris = ProfileSetting(block, 'uri').split()
+        if kind == 'http-get':
+            self.transform = self.Transform(block, 'client', 'metadata')
+            self.output = self.Transform(block, 'server', 'output')
+        else:
+            self.transform = self.Transform(block, 'client', 'id')
+            self.output = self.Transform(block, 'client', 'output')
+        if self.uris == [] or self.transform == None:
+            raise Exception('profile %s: %s %s without uri or %s' % (profile, kind, variant, 'metadata' if kind == 'http-get' else 'id'))
+
+    @staticmethod
+    def Transform(block, side, name):
+        statement = ProfileStatement(block, side)
+        if statement != None:
+            statement = ProfileStatement(statement[2], name)
+        if statement == None or statement[2] == None:
+            return None
+        return cProfileTransform(statement[2])
+
+    def Encode(self, data):
+        if self.output == None:
+            return data
+        return self.output.Encode(data)
+
+    def Decode(self, data):
+        if self.output == None:
+            return data
+        return self.output.Decode(data)
+
+def ProfileTransactions(text, name='profile'):
+    transactions = []
+    for statementName, arguments, block in ParseProfile(text):
+        if statementName in ['http-get', 'http-post'] and block != None:
+            transactions.append(cProfileTransaction(name, statementName, arguments[0].decode('latin-1') if len(arguments) > 0 else 'default', block))
+    if not 'http-get' in [oTransaction.kind for oTransaction in transactions]:
+        raise Exception('profile %s: no http-get' % name)
+    return transactions
+
+# matches flows to the transactions of all loaded profiles: a dictionary for exact URIs, and one precompiled regular expression per verb for URIs followed by uri-append data (longest URI first)
+class cProfiles(object):
+
+    def __init__(self, text=PROFILE):
+        self.Compile(ProfileTransactions(text, 'default'))
+
+    def Compile(self, transactions):
+        dExact = {}
+        dPrefixes = {}
+        for oTransaction in transactions:
+            for uri in oTransaction.uris:
+                if oTransaction.transform.terminator[0] == 'uri-append':
+                    dPrefixes.setdefault(oTransaction.verb, {}).setdefault(uri, []).append(oTransaction)
+                else:
+                    dExact.setdefault((oTransaction.verb, uri), []).append(oTransaction)
+        dRegexes = {}
+        for verb, dURIs in dPrefixes.items():
+            uris = sorted(dURIs, key=len, reverse=True)
+            dRegexes[verb] = [re.compile('|'.join(['(?P<u%d>%s)' % (index, re.escape(uri)) for index, uri in enumerate(uris)])), [[uri, dURIs[uri]] for uri in uris]]
+        self.transactions = transactions
+        self.dExact = dExact
+        self.dRegexes = dRegexes
+
+    def Load(self, path):
+        if path == '':
+            self.Compile(ProfileTransactions(PROFILE, 'default'))
+            return
+        if os.path.isdir(path):
+            filenames = sorted([os.path.join(path, filename) for filename in os.listdir(path) if os.path.isfile(os.path.join(path, filename))])
+        else:
+            filenames = [filename for filename in path.split(',') if filename != '']
+        transactions = []
+        for filename in filenames:
+            with open(filename, 'r') as fProfile:
+                transactions.extend(ProfileTransactions(fProfile.read(), os.path.basename(filename)))
+        self.Compile(transactions)
+        oEventLog.Event(EVENTLOG_INFO, 'profiles', profiles=[os.path.basename(filename) for filename in filenames], transactions=len(transactions))
+
+    # returns [[uri, transaction], ...]
+    def Candidates(self, request):
+        path = request.path.split('?', 1)[0]
+        candidates = [[path, oTransaction] for oTransaction in self.dExact.get((request.method, path), [])]
+        if request.method in self.dRegexes:
+            oRegex, entries = self.dRegexes[request.method]
+            oMatch = oRegex.match(path)
+            if oMatch != None:
+                uri, transactions = entries[int(oMatch.lastgroup[1:])]
+                candidates.extend([[uri, oTransaction] for oTransaction in transactions])
+        return candidates
+
+    # returns [transaction, decoded data] for the first candidate of the given kind whose data is present and decodes
+    def Match(self, request, kind):
+        for uri, oTransaction in self.Candidates(request):
+            if oTransaction.kind != kind:
+                continue
+            data = oTransaction.transform.Extract(request, uri)
+            if data == None or data == b'':
+                continue
+            try:
+                return [oTransaction, oTransaction.transform.Decode(data)]
+            except ValueError:
+                continue
+        return [None, None]
+
+    def Metadata(self, request):
+        return self.Match(request, 'http-get')
+
+    # returns [transaction, bid, decoded output] for a callback
+    def Callback(self, request):
+        oTransaction, data = self.Match(request, 'http-post')
+        if oTransaction == None:
+            return [None, None, None]
+        try:
+            bid = int(data)
+        except ValueError:
+            return [None, None, None]
+        output = request.raw_content
+        if oTransaction.output != None:
+            output = oTransaction.output.Extract(request, '')
+            if output == None:
+                return [None, None, None]
+            try:
+                output = oTransaction.output.Decode(output)
+            except ValueError:
+                return [None, None, None]
+        return [oTransaction, bid, output]
+
+# JSONL events, written by a background thread in batches; the log file is rotated when it exceeds maximumSize
+# filename '' is stdout
+class cEventLog(object):
+
+    def __init__(self, filename='', level=EVENTLOG_LEVEL, maximumSize=EVENTLOG_MAXIMUM_SIZE, rotations=EVENTLOG_ROTATIONS, batch=EVENTLOG_BATCH):
+        self.filename = filename
+        self.level = level
+        self.maximumSize = maximumSize
+        self.rotations = rotations
+        self.batch = batch
+        self.oQueue = queue.Queue(EVENTLOG_QUEUE)
+        self.oThread = None
+        self.countDropped = 0
+
+    def Event(self, level, event, **dFields):
+        if level > self.level:
+            return
+        if self.oThread == None:
+            self.Start()
+        dEvent = {'time': time.time(), 'event': event}
+        dEvent.update(dFields)
+        try:
+            self.oQueue.put_nowait(dEvent)
+        except queue.Full:
+            self.countDropped += 1
+
+    def Start(self):
+        self.oThread = threading.Thread(target=self.Writer, name='cs-mitm-eventlog', daemon=True)
+        self.oThread.start()
+
+    def IsFile(self):
+        return not self.filename in ['', EVENTLOG_STDERR]
+
+    def OpenFile(self):
+        if self.filename == '':
+            return sys.stdout
+        elif self.filename == EVENTLOG_STDERR:
+            return sys.stderr
+        return open(self.filename, 'a')
+
+    def Rotate(self, fOut):
+        fOut.close()
+        for index in range(self.rotations - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.filename, index)):
+                os.replace('%s.%d' % (self.filename, index), '%s.%d' % (self.filename, index + 1))
+        os.replace(self.filename, self.filename + '.1')
+        return self.OpenFile()
+
+    def Writer(self):
+        fOut = self.OpenFile()
+        stop = False
+        while not stop:
+            events = [self.oQueue.get()]
+            try:
+                while len(events) < self.batch:
+                    events.append(self.oQueue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in events:
+                stop = True
+                events = [dEvent for dEvent in events if dEvent != None]
+            fOut.write(''.join([json.dumps(dEvent) + '\n' for dEvent in events]))
+            fOut.flush()
+            if self.IsFile() and self.rotations > 0 and fOut.tell() > self.maximumSize:
+                fOut = self.Rotate(fOut)
+        if self.IsFile():
+            fOut.close()
+
+    def Close(self):
+        if self.oThread != None:
+            self.oQueue.put(None)
+            self.oThread.join()
+            self.oThread = None
+
+    def Open(self, filename, level):
+        self.Close()
+        self.filename = filename
+        self.level = level
+
+# HDR style histogram of durations in microseconds: buckets have a relative width of 1 / 2^(HISTOGRAM_SUB_BITS - 1)
+class cHistogram(object):
+
+    def __init__(self, subBits=HISTOGRAM_SUB_BITS):
+        self.subBits = subBits
+        self.dCounts = {}
+        self.count = 0
+        self.sum = 0.0
+
+    def Index(self, microseconds):
+        magnitude = max(microseconds.bit_length() - self.subBits, 0)
+        return (magnitude << self.subBits) + (microseconds >> magnitude)
+
+    # highest duration in seconds of the bucket
+    def Value(self, index):
+        magnitude = index >> self.subBits
+        return (((index & ((1 << self.subBits) - 1)) + 1) << magnitude) / 1000000.0
+
+    def Record(self, seconds):
+        index = self.Index(int(seconds * 1000000.0))
+        self.dCounts[index] = self.dCounts.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+
+    def Percentile(self, percentage):
+        threshold = percentage / 100.0 * self.count
+        total = 0
+        for index in sorted(self.dCounts.keys()):
+            total += self.dCounts[index]
+            if total >= threshold:
+                return self.Value(index)
+        return 0.0
+
+    def Buckets(self, boundaries):
+        counts = [0] * len(boundaries)
+        for index, count in self.dCounts.items():
+            value = self.Value(index)
+            for iter, boundary in enumerate(boundaries):
+                if value <= boundary:
+                    counts[iter] += count
+                    break
+        total = 0
+        for iter in range(len(counts)):
+            total += counts[iter]
+            counts[iter] = total
+        return counts
+
+# per stage latency histograms and counters, exported in Prometheus text format to a file and/or a localhost HTTP endpoint
+# to keep the overhead in the flow path low, durations are appended to the list returned by Stage, and added to the histograms when exporting
+class cMetrics(object):
+
+    def __init__(self):
+        self.dHistograms = {}
+        self.dPending = {}
+        self.dCounters = collections.defaultdict(int)
+        self.oLock = threading.Lock()
+        self.oServer = None
+        self.filename = ''
+        self.oThread = None
+        self.oStop = threading.Event()
+
+    def Stage(self, stage):
+        with self.oLock:
+            if not stage in self.dPending:
+                self.dPending[stage] = []
+                self.dHistograms[stage] = cHistogram()
+            return self.dPending[stage]
+
+    def Count(self, name, increment=1):
+        self.dCounters[name] += increment
+
+    # the pending lists are emptied in place, because the flow path keeps references to them
+    def Fold(self):
+        with self.oLock:
+            for stage, pending in self.dPending.items():
+                count = len(pending)
+                durations = pending[:count]
+                del pending[:count]
+                oHistogram = self.dHistograms[stage]
+                for duration in durations:
+                    oHistogram.Record(duration)
+
+    def Prometheus(self):
+        lines = []
+        lines.append('# HELP cs_mitm_stage_seconds Duration of the processing stages of cs-mitm')
+        lines.append('# TYPE cs_mitm_stage_seconds histogram')
+        self.Fold()
+        with self.oLock:
+            for stage, oHistogram in sorted(self.dHistograms.items()):
+                for boundary, count in zip(METRICS_BUCKETS, oHistogram.Buckets(METRICS_BUCKETS)):
+                    lines.append('cs_mitm_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, boundary, count))
+                lines.append('cs_mitm_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (stage, oHistogram.count))
+                lines.append('cs_mitm_stage_seconds_sum{stage="%s"} %f' % (stage, oHistogram.sum))
+                lines.append('cs_mitm_stage_seconds_count{stage="%s"} %d' % (stage, oHistogram.count))
+            dCounters = dict(self.dCounters)
+        dStatistics = oKeyStore.Statistics()
+        for name in ['lookups', 'fingerprinthits', 'failures', 'skipped', 'rsaattempts', 'parses']:
+            dCounters['keystore_' + name] = dStatistics[name]
+        dCounters['sessions_evicted'] = oSessions.countEvicted
+        dCounters['eventlog_dropped'] = oEventLog.countDropped
+        for name, value in sorted(dCounters.items()):
+            lines.append('# TYPE cs_mitm_%s_total counter' % name)
+            lines.append('cs_mitm_%s_total %d' % (name, value))
+        lines.append('# TYPE cs_mitm_sessions gauge')
+        lines.append('cs_mitm_sessions %d' % len(oSessions))
+        lines.append('# TYPE cs_mitm_keys gauge')
+        lines.append('cs_mitm_keys %d' % dStatistics['keys'])
+        return '\n'.join(lines) + '\n'
+
+    def WriteFile(self):
+        with open(self.filename + '.tmp', 'w') as fMetrics:
+            fMetrics.write(self.Prometheus())
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def Writer(self):
+        while not self.oStop.wait(METRICS_INTERVAL):
+            self.WriteFile()
+
+    def Start(self, port, filename):
+        self.Stop()
+        if port > 0:
+            self.oServer = http.server.ThreadingHTTPServer(('127.0.0.1', port), cMetricsHandler)
+            threading.Thread(target=self.oServer.serve_forever, name='cs-mitm-metrics', daemon=True).start()
+        self.filename = filename
+        if filename != '':
+            self.oStop.clear()
+            self.oThread = threading.Thread(target=self.Writer, name='cs-mitm-metrics-file', daemon=True)
+            self.oThread.start()
+
+    def Stop(self):
+        if self.oServer != None:
+            self.oServer.shutdown()
+            self.oServer.server_close()
+            self.oServer = None
+        if self.oThread != None:
+            self.oStop.set()
+            self.oThread.join()
+            self.oThread = None
+            self.WriteFile()
+
+class cMetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        data = oMetrics.Prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', '%d' % len(data))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def HeadersToDict(headers):
+    return dict([[str(name), value.decode('latin-1') if isinstance(value, bytes) else str(value)] for name, value in headers.items()])
+
+oEventLog = cEventLog()
+oMetrics = cMetrics()
+oKeyStore = cKeyStore(dKeys)
+oSessions = cSessions()
+oScheduler = cScheduler()
+oSessionStore = cSessionStore()
+oProfiles = cProfiles()
 
 class Addon:
 
     def __init__(self):
         self.exporter = None
+        self.oPool = None
+        self.queueMaximum = RSA_QUEUE_MAXIMUM
+        self.queueDepth = 0
+        self.countPassThrough = 0
+        self.timesRSA = oMetrics.Stage('rsa')
+        self.timesEncrypt = oMetrics.Stage('encrypt')
+        self.timesRewrite = oMetrics.Stage('rewrite')
+        self.timesFlow = oMetrics.Stage('flow')
+        self.timesCallback = oMetrics.Stage('callback')
+        self.Configure(RSA_WORKERS, RSA_QUEUE_MAXIMUM)
+
+    def load(self, loader):
+        loader.add_option(name='csmitm_workers', typespec=int, default=RSA_WORKERS, help='cs-mitm: number of RSA worker threads (0 = decrypt metadata in the event loop)')
+        loader.add_option(name='csmitm_queue', typespec=int, default=RSA_QUEUE_MAXIMUM, help='cs-mitm: maximum number of pending RSA decryptions, flows beyond are passed through')
+        loader.add_option(name='csmitm_log', typespec=str, default='', help='cs-mitm: JSONL event log file (default stdout, %s for stderr)' % EVENTLOG_STDERR)
+        loader.add_option(name='csmitm_loglevel', typespec=int, default=EVENTLOG_LEVEL, help='cs-mitm: event log level: 0 errors, 1 check-ins, tasks and callbacks, 2 all flows and headers, 3 hex dumps of content')
+        loader.add_option(name='csmitm_keys', typespec=str, default='', help='cs-mitm: file or directory with private keys (.pem, .json or text files with hexadecimal public/private key pairs), reloaded when changed')
+        loader.add_option(name='csmitm_metrics_port', typespec=int, default=0, help='cs-mitm: localhost port of the Prometheus metrics endpoint (0 = no endpoint)')
+        loader.add_option(name='csmitm_metrics_file', typespec=str, default='', help='cs-mitm: file to write Prometheus metrics to every %d seconds' % METRICS_INTERVAL)
+        loader.add_option(name='csmitm_sessions', typespec=str, default='', help='cs-mitm: SQLite database to persist beacon sessions across restarts (default: no persistence)')
+        loader.add_option(name='csmitm_profiles', typespec=str, default='', help='cs-mitm: malleable C2 profile files (comma separated) or directory, flows of all profiles are handled (default: metadata in the Cookie header of /match)')
+        loader.add_option(name='csmitm_rules', typespec=str, default='', help='cs-mitm: file with task rules (default: sleep 5 seconds at the first check-in, exit at the second)')
+
+    def configure(self, updated):
+        if 'csmitm_workers' in updated or 'csmitm_queue' in updated:
+            from mitmproxy import ctx
+            self.Configure(ctx.options.csmitm_workers, ctx.options.csmitm_queue)
+        if 'csmitm_log' in updated or 'csmitm_loglevel' in updated:
+            from mitmproxy import ctx
+            oEventLog.Open(ctx.options.csmitm_log, ctx.options.csmitm_loglevel)
+        if 'csmitm_metrics_port' in updated or 'csmitm_metrics_file' in updated:
+            from mitmproxy import ctx
+            oMetrics.Start(ctx.options.csmitm_metrics_port, ctx.options.csmitm_metrics_file)
+        if 'csmitm_keys' in updated:
+            from mitmproxy import ctx
+            oKeyStore.Load(ctx.options.csmitm_keys)
+        if 'csmitm_sessions' in updated:
+            from mitmproxy import ctx
+            oSessionStore.Open(ctx.options.csmitm_sessions)
+        if 'csmitm_profiles' in updated:
+            from mitmproxy import ctx
+            oProfiles.Load(ctx.options.csmitm_profiles)
+        if 'csmitm_rules' in updated:
+            from mitmproxy import ctx
+            if ctx.options.csmitm_rules == '':
+                oScheduler.LoadRules(SCHEDULER_RULES)
+            else:
+                oScheduler.LoadRulesFile(ctx.options.csmitm_rules)
+
+    def Configure(self, workers, queueMaximum):
+        if self.oPool != None:
+            self.oPool.shutdown(wait=False)
+        if workers > 0:
+            self.oPool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cs-mitm-rsa')
+        else:
+            self.oPool = None
+        self.queueMaximum = queueMaximum
+
+    def done(self):
+        oSessionStore.Close()
+        oMetrics.Stop()
+        oEventLog.Close()
+
+    def request(self, flow):
+        oTransaction, bid, output = oProfiles.Callback(flow.request)
+        if oTransaction == None:
+            return
+        oSession = oSessions.Lookup(bid)
+        if oSession == None:
+            return
+        start = time.perf_counter()
+        try:
+            for dCallback in ParseCallbacks(oSession.oCrypto, output):
+                self.Callback(oSession, dCallback)
+        except Exception as e:
+            if str(e) == 'HMAC signature invalid':
+                oMetrics.Count('hmac_failures')
+            else:
+                oMetrics.Count('callback_errors')
+            oEventLog.Event(EVENTLOG_ERROR, 'error', bid=bid, error='callback: %s' % e)
+        self.timesCallback.append(time.perf_counter() - start)
+
+    def Callback(self, oSession, dCallback):
+        oMetrics.Count('callbacks')
+        if oEventLog.level >= EVENTLOG_CONTENT:
+            oEventLog.Event(EVENTLOG_CONTENT, 'callback', bid=oSession.bid, counter=dCallback['counter'], callback=dCallback['callback'], size=len(dCallback['data']), data=dCallback['data'].hex())
+        else:
+            oEventLog.Event(EVENTLOG_INFO, 'callback', bid=oSession.bid, counter=dCallback['counter'], callback=dCallback['callback'], size=len(dCallback['data']))
 
     def response(self, flow):
-        print('cs-mitm: %s' % flow.request.path)
-        if flow.request.path == '/match':
-            encryptedMetadata = binascii.a2b_base64(flow.request.headers['Cookie'])
-            for publicKey, privateKey in dKeys.items():
-                decryptedMetadata = RSADecrypt(privateKey, encryptedMetadata)
-                if decryptedMetadata != None:
-                    print('cs-mitm: %s' % 'Found and decrypted metadata')
-                    rawkey = decryptedMetadata[8:8 + 16]
-                    rawkeyHex = binascii.b2a_hex(rawkey)
-                    print('cs-mitm: %s' % ('Raw key: %s' % rawkeyHex))
-                    dRawkeys[rawkey] = dRawkeys.get(rawkey, 0) + 1
-                    oCrypto = cCrypto(rawkey=rawkeyHex)
-                    if dRawkeys[rawkey] == 1:
-                        exitTask = oCrypto.Encrypt(cTask().Sleep(5000, 0)) # sleep 5 seconds
-                        print('cs-mitm: %s' % 'Sending "sleep 5" command')
-                    elif dRawkeys[rawkey] == 2:
-                        exitTask = oCrypto.Encrypt(cTask().Exit()) # exit
-                        print('cs-mitm: %s' % 'Sending "exit" command')
-                    print('cs-mitm: %s' % flow.response.headers)
-                    print('cs-mitm: %s' % flow.response.raw_content)
-                    flow.response.headers['Content-Length'] = b'%d' % len(exitTask)
-                    flow.response.raw_content = exitTask
-                    print('cs-mitm: %s' % flow.response.headers)
-                    print('cs-mitm: %s' % flow.response.raw_content)
-                    break
+        oEventLog.Event(EVENTLOG_DEBUG, 'flow', method=flow.request.method, path=flow.request.path)
+        oTransaction, encryptedMetadata = oProfiles.Metadata(flow.request)
+        if oTransaction != None:
+            start = time.perf_counter()
+            oKeyStore.Poll()
+            fingerprint = hashlib.sha256(encryptedMetadata).digest()
+            result, countKeysTried = oKeyStore.Cached(fingerprint)
+            if result == None and self.oPool == None:
+                result = oKeyStore.TryKeys(encryptedMetadata, fingerprint, countKeysTried)
+            if result != None:
+                self.timesRSA.append(time.perf_counter() - start)
+                self.Respond(flow, oTransaction, fingerprint, result, start)
+            elif self.queueDepth >= self.queueMaximum:
+                self.countPassThrough += 1
+                oMetrics.Count('passthrough')
+                oEventLog.Event(EVENTLOG_ERROR, 'passthrough', path=flow.request.path, error='RSA worker pool saturated')
+            else:
+                # mitmproxy awaits the returned coroutine
+                return self.ResponseAsync(flow, oTransaction, encryptedMetadata, fingerprint, countKeysTried, start)
+
+    async def ResponseAsync(self, flow, oTransaction, encryptedMetadata, fingerprint, countKeysTried, start):
+        self.queueDepth += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.oPool, oKeyStore.TryKeys, encryptedMetadata, fingerprint, countKeysTried)
+        finally:
+            self.queueDepth -= 1
+        self.timesRSA.append(time.perf_counter() - start)
+        self.Respond(flow, oTransaction, fingerprint, result, start)
+
+    def Respond(self, flow, oTransaction, fingerprint, result, start):
+        self.RespondStages(flow, oTransaction, fingerprint, result[0], result[1])
+        self.timesFlow.append(time.perf_counter() - start)
+        if len(self.timesFlow) >= METRICS_PENDING_MAXIMUM:
+            oMetrics.Fold()
+
+    def RespondStages(self, flow, oTransaction, fingerprint, publicKey, decryptedMetadata):
+        if decryptedMetadata != None:
+            dMetadata = ParseMetadata(decryptedMetadata)
+            rawkey = decryptedMetadata[8:8 + 16]
+            oSession = oSessions.Checkin(rawkey, dMetadata.get('bid'))
+            oSession.fingerprint = fingerprint
+            oSession.publicKey = publicKey
+            oSession.metadata = decryptedMetadata
+            oEventLog.Event(EVENTLOG_INFO, 'checkin', checkin=oSession.checkins, **dMetadata)
+            commands = oScheduler.Tasks(oSession)
+            oSessionStore.Save(oSession)
+            if commands == []:
+                return
+            startStage = time.perf_counter()
+            tasks = oTransaction.Encode(oSession.oCrypto.Encrypt(cTask.PackageCommands(commands)))
+            self.timesEncrypt.append(time.perf_counter() - startStage)
+            oMetrics.Count('tasks', len(commands))
+            oEventLog.Event(EVENTLOG_INFO, 'tasks', rawkey=dMetadata['rawkey'], checkin=oSession.checkins, commands=[struct.unpack('>I', command[:4])[0] for command in commands])
+            if oEventLog.level >= EVENTLOG_CONTENT:
+                oEventLog.Event(EVENTLOG_CONTENT, 'response', rawkey=dMetadata['rawkey'], headers=HeadersToDict(flow.response.headers), content=flow.response.raw_content.hex())
+            startStage = time.perf_counter()
+            flow.response.headers['Content-Length'] = b'%d' % len(tasks)
+            flow.response.raw_content = tasks
+            self.timesRewrite.append(time.perf_counter() - startStage)
+            oEventLog.Event(EVENTLOG_DEBUG, 'rewritten', rawkey=dMetadata['rawkey'], headers=HeadersToDict(flow.response.headers))
+            if oEventLog.level >= EVENTLOG_CONTENT:
+                oEventLog.Event(EVENTLOG_CONTENT, 'rewritten', rawkey=dMetadata['rawkey'], content=tasks.hex())
 
 addons = [Addon()]
+
+class cFlowSimulated(object):
+
+    class cMessage(object):
+
+        def __init__(self, path='', headers=None, raw_content=b'', method='GET'):
+            self.method = method
+            self.path = path
+            self.query = dict(urllib.parse.parse_qsl(path.split('?', 1)[1])) if '?' in path else {}
+            self.headers = headers or {}
+            self.raw_content = raw_content
+
+    def __init__(self, path, cookie, headers=None, method='GET'):
+        self.request = __class__.cMessage(path, dict(headers or {}, Cookie=cookie) if cookie != '' else dict(headers or {}), method=method)
+        self.response = __class__.cMessage('', {'Content-Length': b'0'})
+
+def Percentile(values, percentage):
+    if values == []:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(percentage / 100.0 * (len(values) - 1)))]
+
+def SimulatedKeyStoreKey(keysize=1024):
+    oPrivateKey = Crypto.PublicKey.RSA.generate(keysize)
+    publicKey = binascii.b2a_hex(oPrivateKey.publickey().export_key('DER')).decode()
+    privateKey = binascii.b2a_hex(oPrivateKey.export_key('DER', pkcs=8)).decode()
+    return [oPrivateKey.publickey(), publicKey, privateKey]
+
+# same layout as beacon metadata: magic, size, raw key, charsets, bid, pid, port, flags, version, build, pointers, IPv4 address, info
+def SimulatedMetadata(oPublicKey, rawkey, bid=None, pid=None):
+    if bid == None:
+        bid = random.randrange(0, 0x7FFFFFFF, 2)
+    if pid == None:
+        pid = random.randrange(1000, 20000, 4)
+    info = b'DESKTOP-%04d\tuser%d\tbeacon.exe' % (bid % 10000, bid % 100)
+    metadata = rawkey + struct.pack('<HH', 1252, 437) + struct.pack('>IIHBBBHIIII', bid, pid, 0, 14, 10, 0, 19041, 0, 0, 0, random.randrange(0x0A000000, 0x0AFFFFFF)) + info
+    metadata = struct.pack('>II', 0xBEEF, len(metadata)) + metadata
+    return binascii.b2a_base64(Crypto.Cipher.PKCS1_v1_5.new(oPublicKey).encrypt(metadata), newline=False).decode()
+
+def PrintStages():
+    oMetrics.Fold()
+    for stage, oHistogram in sorted(oMetrics.dHistograms.items()):
+        if oHistogram.count > 0:
+            print('stage %-13s count: %d p50: %.3f ms p99: %.3f ms' % (stage, oHistogram.count, oHistogram.Percentile(50) * 1000.0, oHistogram.Percentile(99) * 1000.0))
+
+# burst of check-ins from new beacons, interleaved with other flows; latency is measured from the start of the burst
+def LoadTest(countBeacons, workers, queueMaximum):
+    oPublicKey, publicKey, privateKey = SimulatedKeyStoreKey()
+    oKeyStore.AddKey(publicKey, privateKey)
+    flows = []
+    for iter in range(countBeacons):
+        flows.append(cFlowSimulated('/match', SimulatedMetadata(oPublicKey, os.urandom(16))))
+        flows.append(cFlowSimulated('/other', ''))
+    oAddon = Addon()
+    oAddon.Configure(workers, queueMaximum)
+    dLatencies = {'/match': [], '/other': []}
+
+    async def Flow(oFlow, start):
+        result = oAddon.response(oFlow)
+        if result != None:
+            await result
+        dLatencies[oFlow.request.path].append(time.perf_counter() - start)
+
+    async def Burst():
+        start = time.perf_counter()
+        await asyncio.gather(*[Flow(oFlow, start) for oFlow in flows])
+        return time.perf_counter() - start
+
+    oEventLog.Open(os.devnull, EVENTLOG_LEVEL)
+    duration = asyncio.run(Burst())
+    oEventLog.Close()
+    oAddon.Configure(0, queueMaximum)
+    print('Workers: %d queue: %d beacons: %d flows: %d passed through: %d' % (workers, queueMaximum, countBeacons, len(flows), oAddon.countPassThrough))
+    print('Duration: %.3f s' % duration)
+    for path, latencies in sorted(dLatencies.items()) + [['all', dLatencies['/match'] + dLatencies['/other']]]:
+        print('%-6s flows p50: %.2f ms p99: %.2f ms max: %.2f ms' % (path, Percentile(latencies, 50) * 1000.0, Percentile(latencies, 99) * 1000.0, max(latencies) * 1000.0))
+    PrintStages()
+
+# generates RSA key pairs and writes them to a temporary key store directory (created in directory keys, if given), and drives Addon.response with simulated check-ins
+# the temporary directory is removed afterwards; it is a subdirectory, so a proxy using keys as key directory does not load the generated keys
+# each round, all beacons check in concurrently; latency is measured per flow
+def Benchmark(countBeacons, countCheckins, countKeys, keys, workers, queueMaximum):
+    if keys != '' and not os.path.isdir(keys):
+        raise Exception('Benchmark: %s is not a directory' % keys)
+    directory = tempfile.mkdtemp(prefix='cs-mitm-benchmark-', dir=None if keys == '' else keys)
+    try:
+        simulatedKeys = [SimulatedKeyStoreKey() for iter in range(countKeys)]
+        with open(os.path.join(directory, 'cs-mitm-benchmark.txt'), 'w') as fKeys:
+            for oPublicKey, publicKey, privateKey in simulatedKeys:
+                fKeys.write('%s %s\n' % (publicKey, privateKey))
+        oEventLog.Open(os.devnull, EVENTLOG_LEVEL)
+        oKeyStore.Load(directory)
+        cookies = [SimulatedMetadata(random.choice(simulatedKeys)[0], os.urandom(16)) for iter in range(countBeacons)]
+        oAddon = Addon()
+        oAddon.Configure(workers, queueMaximum)
+        oHistogram = cHistogram()
+
+        async def Flow(cookie):
+            oFlow = cFlowSimulated('/match', cookie)
+            start = time.perf_counter()
+            result = oAddon.response(oFlow)
+            if result != None:
+                await result
+            oHistogram.Record(time.perf_counter() - start)
+
+        async def Rounds():
+            start = time.perf_counter()
+            for iter in range(countCheckins):
+                await asyncio.gather(*[Flow(cookie) for cookie in cookies])
+            return time.perf_counter() - start
+
+        duration = asyncio.run(Rounds())
+        oEventLog.Close()
+        oAddon.Configure(0, queueMaximum)
+    finally:
+        shutil.rmtree(directory)
+    dStatistics = oKeyStore.Statistics()
+    print('Keys: %d beacons: %d check-ins per beacon: %d workers: %d queue: %d' % (dStatistics['keys'], countBeacons, countCheckins, workers, queueMaximum))
+    print('Flows: %d duration: %.3f s flows/second: %.1f passed through: %d' % (oHistogram.count, duration, oHistogram.count / duration, oAddon.countPassThrough))
+    print('Latency p50: %.3f ms p90: %.3f ms p99: %.3f ms p99.9: %.3f ms max: %.3f ms' % tuple([oHistogram.Percentile(percentage) * 1000.0 for percentage in [50, 90, 99, 99.9, 100]]))
+    print('RSA attempts: %d average per lookup: %.2f fingerprint hits: %d key parses: %d' % (dStatistics['rsaattempts'], dStatistics['averagersaattempts'], dStatistics['fingerprinthits'], dStatistics['parses']))
+    PrintStages()
+
+# encryption of one task for many sessions: the per-call path as it was (new AES and HMAC objects per call, packaging per session), per-call with reused contexts, and batch
+def CryptoBenchmark(countBeacons, countRounds):
+    cryptos = [cCrypto(os.urandom(16).hex()) for iter in range(countBeacons)]
+    commands = [cTask.Command(4, struct.pack('>II', 5000, 0))]
+
+    def EncryptReference(oCrypto, commands):
+        commands = b''.join(commands)
+        data = cTask.PadToMultiple(struct.pack('>II', int(time.time()), len(commands)) + commands, 16)
+        cypher = Crypto.Cipher.AES.new(oCrypto.aeskey, Crypto.Cipher.AES.MODE_CBC, CS_FIXED_IV)
+        encryptedData = cypher.encrypt(data)
+        return encryptedData + hmac.new(oCrypto.hmackey, encryptedData, hashlib.sha256).digest()[:16]
+
+    def Reference():
+        return [EncryptReference(oCrypto, commands) for oCrypto in cryptos]
+
+    def PerCall():
+        return [oCrypto.Encrypt(cTask.PackageCommands(commands)) for oCrypto in cryptos]
+
+    def Batch():
+        return cCrypto.EncryptBatch(cryptos, cTask.PackageCommands(commands))
+
+    identical = True
+    for iter in range(3):
+        second = int(time.time())
+        results = [Reference(), PerCall(), Batch()]
+        if int(time.time()) == second:
+            identical = identical and [bytes(result) for result in results[1]] == results[0] and [bytes(result) for result in results[2]] == results[0]
+    print('Sessions: %d rounds: %d results identical: %s' % (countBeacons, countRounds, identical))
+    for name, function in [['reference', Reference], ['per-call', PerCall], ['batch', Batch]]:
+        durations = []
+        for iter in range(countRounds):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+        print('%-9s p50: %.3f ms min: %.3f ms per session: %.2f us' % (name, Percentile(durations, 50) * 1000.0, min(durations) * 1000.0, Percentile(durations, 50) * 1000000.0 / countBeacons))
+
+# JSONL records: {"path": "/match", "cookie": "...", "response": "<BASE64 response content>"}, optional "method" and "headers" for other profiles
+def ReplayRecordsJSONL(filename):
+    with open(filename, 'r') as fIn:
+        for line in fIn:
+            line = line.strip()
+            if line == '':
+                continue
+            dRecord = json.loads(line)
+            oFlow = cFlowSimulated(dRecord.get('path', ''), dRecord.get('cookie', ''), dRecord.get('headers'), dRecord.get('method', 'GET'))
+            yield {'request': oFlow.request, 'response': binascii.a2b_base64(dRecord.get('response', ''))}
+
+def ReplayRecordsMitmproxy(filename):
+    import mitmproxy.io
+    import mitmproxy.http
+    with open(filename, 'rb') as fIn:
+        for flow in mitmproxy.io.FlowReader(fIn).stream():
+            if isinstance(flow, mitmproxy.http.HTTPFlow):
+                yield {'request': flow.request, 'response': b'' if flow.response == None else flow.response.raw_content}
+
+def ReplayRecords(filename):
+    if os.path.splitext(filename)[1].lower() in ['.jsonl', '.json']:
+        return ReplayRecordsJSONL(filename)
+    else:
+        return ReplayRecordsMitmproxy(filename)
+
+# the event log (stdout by default) is written to stderr, not to the replay output
+def ReplayInitializer(keys):
+    oEventLog.Open(EVENTLOG_STDERR, EVENTLOG_LEVEL)
+    if keys != '':
+        oKeyStore.Load(keys)
+
+def ReplayDecryptMetadata(encryptedMetadata):
+    return oKeyStore.DecryptMetadata(encryptedMetadata)
+
+# records are processed in chunks: the RSA decryption of the metadata of a chunk is done by a process pool, the rest sequentially in flow order
+def Replay(filenames, fOut, processes, keys='', chunk=REPLAY_CHUNK):
+    oReplaySessions = cSessions(maximum=sys.maxsize, idleTimeout=sys.maxsize)
+    dMetadataCache = collections.OrderedDict()
+    counter = 0
+
+    def Output(dEvent):
+        fOut.write(json.dumps(dEvent) + '\n')
+
+    def ProcessChunk(oPool, records):
+        nonlocal counter
+        fingerprints = []
+        transactions = []
+        dTodo = {}
+        # results of the chunk (cache hits and new decryptions): the cache is only trimmed after the records of the chunk are processed
+        dResults = {}
+        for dRecord in records:
+            fingerprint = None
+            oTransaction, encryptedMetadata = oProfiles.Metadata(dRecord['request'])
+            if oTransaction != None:
+                fingerprint = hashlib.sha256(encryptedMetadata).digest()
+                if fingerprint in dMetadataCache:
+                    dMetadataCache.move_to_end(fingerprint)
+                    dResults[fingerprint] = dMetadataCache[fingerprint]
+                else:
+                    dTodo[fingerprint] = encryptedMetadata
+            fingerprints.append(fingerprint)
+            transactions.append(oTransaction)
+        todo = list(dTodo.items())
+        if oPool == None:
+            results = map(ReplayDecryptMetadata, [encryptedMetadata for fingerprint, encryptedMetadata in todo])
+        else:
+            results = oPool.map(ReplayDecryptMetadata, [encryptedMetadata for fingerprint, encryptedMetadata in todo], chunksize=max(1, len(todo) // (processes * 4)))
+        for (fingerprint, encryptedMetadata), result in zip(todo, results):
+            dResults[fingerprint] = result
+            dMetadataCache[fingerprint] = result
+        for dRecord, fingerprint, oTransaction in zip(records, fingerprints, transactions):
+            counter += 1
+            if fingerprint == None:
+                continue
+            publicKey, decryptedMetadata = dResults[fingerprint]
+            if decryptedMetadata == None:
+                Output({'flow': counter, 'type': 'error', 'error': 'metadata not decrypted'})
+                continue
+            dMetadata = ParseMetadata(decryptedMetadata)
+            Output(dict({'flow': counter, 'type': 'metadata', 'publickey': hashlib.sha256(publicKey.encode()).hexdigest()}, **dMetadata))
+            oSession = oReplaySessions.Checkin(decryptedMetadata[8:8 + 16])
+            if len(dRecord['response']) == 0:
+                continue
+            try:
+                timestamp, tasks = ParseTasks(oSession.oCrypto.Decrypt(oTransaction.Decode(dRecord['response'])))
+            except Exception as e:
+                Output({'flow': counter, 'type': 'error', 'rawkey': dMetadata['rawkey'], 'error': str(e)})
+                continue
+            Output({'flow': counter, 'type': 'tasks', 'rawkey': dMetadata['rawkey'], 'checkin': oSession.checkins, 'timestamp': timestamp, 'tasks': tasks})
+        while len(dMetadataCache) > KEYSTORE_MAXIMUM_FINGERPRINTS:
+            dMetadataCache.popitem(last=False)
+
+    oPool = None
+    oEventLog.Open(EVENTLOG_STDERR, EVENTLOG_LEVEL)
+    if processes > 0:
+        oPool = concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=ReplayInitializer, initargs=(keys, ))
+    else:
+        ReplayInitializer(keys)
+    try:
+        records = []
+        for filename in filenames:
+            for dRecord in ReplayRecords(filename):
+                records.append(dRecord)
+                if len(records) == chunk:
+                    ProcessChunk(oPool, records)
+                    records = []
+        if records != []:
+            ProcessChunk(oPool, records)
+    finally:
+        if oPool != None:
+            oPool.shutdown()
+        oEventLog.Close()
+    return counter
+
+def Main():
+    oParser = optparse.OptionParser(usage='usage: %prog [options] loadtest\n       %prog [options] benchmark\n       %prog [options] cryptobenchmark\n       %prog [options] replay capture ...\nmitmproxy script to intercept, decrypt and inject commands into Cobalt Strike beacon network traffic\nRun it with mitmproxy (-s cs-mitm.py), or standalone for the commands listed here\nreplay decrypts recorded traffic: mitmproxy flow files, or .jsonl files with records {"path": ..., "cookie": ..., "response": BASE64}')
+    oParser.add_option('-b', '--beacons', type=int, default=200, help='Number of simulated beacons (default 200)')
+    oParser.add_option('-c', '--checkins', type=int, default=5, help='Number of check-ins per simulated beacon for benchmark, number of rounds for cryptobenchmark (default 5)')
+    oParser.add_option('-n', '--numberkeys', type=int, default=10, help='Number of RSA key pairs to generate for benchmark (default 10)')
+    oParser.add_option('-w', '--workers', type=int, default=RSA_WORKERS, help='Number of RSA worker threads (default %d)' % RSA_WORKERS)
+    oParser.add_option('-q', '--queue', type=int, default=RSA_QUEUE_MAXIMUM, help='Maximum number of pending RSA decryptions (default %d)' % RSA_QUEUE_MAXIMUM)
+    oParser.add_option('-p', '--processes', type=int, default=os.cpu_count(), help='Number of RSA worker processes for replay, 0 = no pool (default %d)' % os.cpu_count())
+    oParser.add_option('-k', '--keys', type=str, default='', help='File or directory with private keys, used besides the keys in the script (benchmark: directory to create the temporary directory with the generated keys in, default the system temporary directory)')
+    oParser.add_option('-o', '--output', type=str, default='', help='Output JSONL file for replay (default stdout)')
+    oParser.add_option('-P', '--profiles', type=str, default='', help='Malleable C2 profile files (comma separated) or directory for replay (default: metadata in the Cookie header of /match)')
+    (options, args) = oParser.parse_args()
+
+    if options.profiles != '':
+        oEventLog.Open(EVENTLOG_STDERR, EVENTLOG_LEVEL)
+        oProfiles.Load(options.profiles)
+
+    if len(args) == 1 and args[0] == 'loadtest':
+        LoadTest(options.beacons, options.workers, options.queue)
+    elif len(args) == 1 and args[0] == 'cryptobenchmark':
+        CryptoBenchmark(options.beacons, options.checkins)
+    elif len(args) == 1 and args[0] == 'benchmark':
+        Benchmark(options.beacons, options.checkins, options.numberkeys, options.keys, options.workers, options.queue)
+    elif len(args) > 1 and args[0] == 'replay':
+        if options.output == '':
+            Replay(args[1:], sys.stdout, options.processes, options.keys)
+        else:
+            with open(options.output, 'w') as fOut:
+                Replay(args[1:], fOut, options.processes, options.keys)
+    else:
+        oParser.print_help()
+
+if __name__ == '__main__':
+    Main()
@@ -71,6 +71,8 @@ import fnmatch
 import json
 import time
 import csv
+import codecs
+import itertools
 if sys.version_info[0] >= 3:
     from io import BytesIO as DataIO
 else:
@@ -1476,6 +1478,80 @@ def InstantiateCOutput(options):
         filenameOption = options.output
     return cOutput(filenameOption)
 
+DECODE_CHUNK = 0x100000 # bytes read per chunk by the streaming decoder
+HEX_BLOCK = 0x1000 # text with invalid hexadecimal pairs is decoded per block of this size, pair by pair
+
+# reads a binary file in chunks and yields its text, decoded as UTF-8 like bytes.decode() (characters can straddle chunks)
+def TextChunks(fIn, size=DECODE_CHUNK):
+    oDecoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = fIn.read(size)
+        text = oDecoder.decode(data, len(data) == 0)
+        if text != '':
+            yield text
+        if len(data) == 0:
+            break
+
+# reads text chunks until search is found at a position >= before, with at least after characters following it, or until the end
+# returns [text read, position of search or -1]; the remaining text is left in chunks
+def ReadUntilFound(chunks, search, before, after):
+    texts = []
+    length = 0
+    position = -1
+    previous = ''
+    for text in chunks:
+        if position == -1:
+            found = (previous + text).find(search)
+            if found != -1:
+                position = length - len(previous) + found
+        texts.append(text)
+        length += len(text)
+        previous = text[-len(search) + 1:]
+        if position >= before and length >= position + after:
+            break
+    return [''.join(texts), position]
+
+# one str.translate table with the same result as str.replace for each key of dSubstitute in order (keys are characters, values can be longer)
+def SubstitutionTable(dSubstitute):
+    table = {}
+    for character in dSubstitute:
+        value = character
+        for key, replacement in dSubstitute.items():
+            value = value.replace(key, replacement)
+        table[ord(character)] = value
+    return table
+
+# pairs of hexadecimal digits to bytes, a pair that int(pair, 16) can not parse is 0, a single trailing digit is a byte
+def HexPairs(text):
+    try:
+        data = bytes.fromhex(text)
+        # bytes.fromhex skips whitespace: then there are less bytes than pairs
+        if len(data) * 2 == len(text):
+            return data
+    except ValueError:
+        pass
+    if len(text) > HEX_BLOCK:
+        return b''.join([HexPairs(text[index:index + HEX_BLOCK]) for index in range(0, len(text), HEX_BLOCK)])
+    data = []
+    for index in range(0, len(text), 2):
+        try:
+            data.append(int(text[index:index + 2], 16))
+        except ValueError:
+            data.append(0)
+    return bytes(data)
+
+# yields the bytes of hexadecimal text chunks, pairs can straddle chunks; all but the last yielded chunk are a multiple of alignment bytes long
+def HexPairsToBytes(chunks, alignment=1):
+    carry = ''
+    for text in chunks:
+        text = carry + text
+        size = len(text) - len(text) % (2 * alignment)
+        carry = text[size:]
+        if size > 0:
+            yield HexPairs(text[:size])
+    if carry != '':
+        yield HexPairs(carry)
+
 def ProcessBinaryFile(filename, content, cutexpression, flag, oOutput, oLogfile, options, oParserFlag):
     if content == None:
         try:
@@ -1484,15 +1560,20 @@ def ProcessBinaryFile(filename, content, cutexpression, flag, oOutput, oLogfile,
             oLogfile.LineError('Opening file %s %s' % (filename, repr(sys.exc_info()[1])))
             return
         oLogfile.Line('Success', 'Opening file %s' % filename)
-        try:
-            data = oBinaryFile.read()
-        except:
-            oLogfile.LineError('Reading file %s %s' % (filename, repr(sys.exc_info()[1])))
-            return
-        data = CutData(data, cutexpression)[0]
-        oBinaryFile.close()
+        if cutexpression == '':
+            # the file is read in chunks by the decoder, payloads larger than memory are supported
+            fIn = oBinaryFile
+        else:
+            try:
+                data = oBinaryFile.read()
+            except:
+                oLogfile.LineError('Reading file %s %s' % (filename, repr(sys.exc_info()[1])))
+                return
+            data = CutData(data, cutexpression)[0]
+            oBinaryFile.close()
+            fIn = DataIO(data)
     else:
-        data = content
+        fIn = DataIO(content)
 
     (flagoptions, flagargs) = oParserFlag.parse_args(flag.split(' '))
 
@@ -1508,12 +1589,12 @@ def ProcessBinaryFile(filename, content, cutexpression, flag, oOutput, oLogfile,
             'q': '000',
         }
 
-        encodedpayload = data.decode()
-
         dos = '!This program cannot be run in DOS mode'
         doshex = binascii.b2a_hex(dos.encode()).decode()
         oOutput.Line(doshex)
-        position = encodedpayload.find('uy')
+        # only the start of the payload is read to recover the substitution, the rest is decoded chunk by chunk
+        chunks = TextChunks(fIn)
+        encodedpayload, position = ReadUntilFound(chunks, 'uy', 2, len(doshex) - 2)
         oOutput.Line('Position: %d' % position)
         dosencoded = encodedpayload[position - 2:position - 2 + len(doshex)]
         oOutput.Line(dosencoded)
@@ -1536,31 +1617,38 @@ def ProcessBinaryFile(filename, content, cutexpression, flag, oOutput, oLogfile,
             if not key in dSubstitute.values():
                 oOutput.Line(key)
 
-        for key, value in dSubstitute.items():
-            encodedpayload = encodedpayload.replace(key, value)
+        table = SubstitutionTable(dSubstitute)
+        encodedpayload = encodedpayload.translate(table)
+        while len(encodedpayload) < 80:
+            text = next(chunks, None)
+            if text == None:
+                break
+            encodedpayload += text.translate(table)
 
         oOutput.Line('Partially decoded payload: %s' % encodedpayload[:80])
-        
-        data = []
-        while len(encodedpayload) > 0:
-            hexbyte = encodedpayload[:2]
-            encodedpayload = encodedpayload[2:]
-            try:
-                data.append(int(hexbyte, 16))
-            except ValueError:
-                data.append(0)
-        data = bytes(data)
 
-        oOutput.Line(cDump(data).HexAsciiDump())
-        
-        with open('payload.exe.vir', 'wb') as fOut:
-            fOut.write(data)
-        
+        # the dump is output per chunk of whole dump lines, the payload is written to a temporary file that replaces payload.exe.vir when it is complete
+        offset = 0
+        try:
+            with open('payload.exe.vir.part', 'wb') as fOut:
+                for data in HexPairsToBytes(itertools.chain([encodedpayload], (text.translate(table) for text in chunks)), 16):
+                    oOutput.Line(cDump(data, offset=offset).HexAsciiDump()[:-1])
+                    fOut.write(data)
+                    offset += len(data)
+        except:
+            if os.path.isfile('payload.exe.vir.part'):
+                os.remove('payload.exe.vir.part')
+            raise
+        oOutput.Line('')
+        os.replace('payload.exe.vir.part', 'payload.exe.vir')
+
         # ----------------------------------------------
     except:
         oLogfile.LineError('Processing file %s %s' % (filename, repr(sys.exc_info()[1])))
         if not options.ignoreprocessingerrors:
             raise
+    finally:
+        fIn.close()
 
 #    data = CutData(cBinaryFile(filename, C2BIP3(options.password), options.noextraction, options.literalfilenames).Data(), cutexpression)[0]
 
@@ -5,20 +5,82 @@
 import struct
 from Crypto.Cipher import ARC4
 import string
+import math
+import collections
+import operator
+import optparse
+import re
+import os
+import sys
+import time
+import mmap
+import zlib
+import glob
+import json
+import hashlib
+import concurrent.futures
+import functools
+import tempfile
+import tracemalloc
+import multiprocessing.shared_memory
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def CalculateByteStatistics(dPrevalence=None, data=None):
+ENTROPY_THRESHOLD = 7.5
+CLASSIFIER_MINIMUM_SIZE = 0x800 # shorter decrypted samples are not accepted by the entropy and printable classifiers: a few random bytes always have a low entropy
+# number of decrypted bytes scored per candidate offset, None = all; smaller samples have a lower maximum entropy, keep it at 2 KiB or more
+SCAN_PREFIX_SIZE = 0x1000
+RC4_CHUNK = 0x10000 # RC4 output is produced in chunks of this size and copied into the output buffer
+SCAN_OFFSETS = list(range(16))
+STATISTICS_NUMPY_MINIMUM = 0x10000 # smaller data is counted without NumPy
+STATISTICS_NUMPY_CHUNK = 0x40000
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PRINTABLE = string.printable.encode()
+HEADER_SIZE = 4*5 # header of the decrypted data: header, size decrypted, shellcode entrypoint, shellcode size, unknown; followed by the shellcode
+
+# the original per-byte loop, kept as reference for parity checks
+def CountBytesReference(data):
+    averageConsecutiveByteDifference = None
+    dPrevalence = {iter: 0 for iter in range(0x100)}
+    sumDifferences = 0.0
+    previous = None
+    if len(data) > 1:
+        for byte in data:
+            dPrevalence[byte] += 1
+            if previous != None:
+                sumDifferences += abs(byte - previous)
+            previous = byte
+        averageConsecutiveByteDifference = sumDifferences /float(len(data)-1)
+    return dPrevalence, averageConsecutiveByteDifference
+
+# same result as CountBytesReference: counting and differences are done by C loops (Counter, map) or by NumPy (bincount and diff, in chunks to limit the temporary arrays)
+# the sum of differences is an integer below 2^53, so the float division gives the same average
+def CountBytes(data, useNumPy=True):
+    dPrevalence = {iter: 0 for iter in range(0x100)}
+    if len(data) <= 1:
+        return dPrevalence, None
+    if useNumPy and numpy != None and len(data) >= STATISTICS_NUMPY_MINIMUM:
+        array = numpy.frombuffer(data, dtype=numpy.uint8)
+        counts = numpy.zeros(0x100, dtype=numpy.int64)
+        sumDifferences = 0
+        for position in range(0, len(array), STATISTICS_NUMPY_CHUNK):
+            counts += numpy.bincount(array[position:position + STATISTICS_NUMPY_CHUNK], minlength=0x100)
+            sumDifferences += int(numpy.abs(numpy.diff(array[position:position + STATISTICS_NUMPY_CHUNK + 1].astype(numpy.int16))).sum())
+        dPrevalence = dict(enumerate(counts.tolist()))
+    else:
+        dPrevalence.update(collections.Counter(data))
+        sumDifferences = sum(map(abs, map(operator.sub, data, memoryview(data)[1:])))
+    return dPrevalence, sumDifferences / float(len(data) - 1)
+
+def CalculateByteStatistics(dPrevalence=None, data=None, reference=False):
     averageConsecutiveByteDifference = None
     if dPrevalence == None:
-        dPrevalence = {iter: 0 for iter in range(0x100)}
-        sumDifferences = 0.0
-        previous = None
-        if len(data) > 1:
-            for byte in data:
-                dPrevalence[byte] += 1
-                if previous != None:
-                    sumDifferences += abs(byte - previous)
-                previous = byte
-            averageConsecutiveByteDifference = sumDifferences /float(len(data)-1)
+        if reference:
+            dPrevalence, averageConsecutiveByteDifference = CountBytesReference(data)
+        else:
+            dPrevalence, averageConsecutiveByteDifference = CountBytes(data)
     sumValues = sum(dPrevalence.values())
     countNullByte = dPrevalence[0]
     countControlBytes = 0
@@ -58,26 +120,616 @@ def CalculateByteStatistics(dPrevalence=None, data=None):
             countUniqueBytes += 1
     return sumValues, entropy, countUniqueBytes, countNullByte, countControlBytes, countWhitespaceBytes, countPrintableBytes, countHighBytes, countHexadecimalBytes, countBASE64Bytes, averageConsecutiveByteDifference
 
-def Scan(dataArg):
-    for offset in range(16):
-        data = dataArg[offset:]
-        key = data[:8]
-        data = data[8:]
-        oRC4 = ARC4.new(key)
-        decrypted = oRC4.decrypt(data)
-        result = CalculateByteStatistics(data=decrypted)
-        if result[1] < 7.5:
-            return [offset, decrypted]
-    return [None, None]
+# decrypts data (a memoryview) chunk by chunk into output (a memoryview of the same size)
+def RC4DecryptInto(oRC4, data, output):
+    for position in range(0, len(data), RC4_CHUNK):
+        output[position:position + RC4_CHUNK] = oRC4.decrypt(data[position:position + RC4_CHUNK])
+
+# entropy of the decrypted data of a candidate offset, computed from byte counts accumulated chunk by chunk (the entropy only depends on the counts)
+# stop: optional buffer, the scoring is abandoned (None) when its first byte is set
+def ScoreOffset(view, offset, prefixSize=None, stop=None):
+    data = view[offset + 8:]
+    if prefixSize != None:
+        data = data[:prefixSize]
+    oRC4 = ARC4.new(view[offset:offset + 8])
+    if numpy != None:
+        counts = numpy.zeros(0x100, dtype=numpy.int64)
+    else:
+        counts = collections.Counter()
+    for position in range(0, len(data), RC4_CHUNK):
+        if stop != None and stop[0] != 0:
+            return None
+        decrypted = oRC4.decrypt(data[position:position + RC4_CHUNK])
+        if numpy != None:
+            counts += numpy.bincount(numpy.frombuffer(decrypted, dtype=numpy.uint8), minlength=0x100)
+        else:
+            counts.update(decrypted)
+    if len(data) <= 1:
+        return 0.0
+    if numpy != None:
+        counts = counts.tolist()
+    return CalculateByteStatistics(dPrevalence={iter: counts[iter] for iter in range(0x100)})[1]
+
+# shared memory: stop byte followed by the data
+def ScoreOffsetShared(name, size, offset, prefixSize=None):
+    oSharedMemory = multiprocessing.shared_memory.SharedMemory(name=name)
+    error = None
+    try:
+        with oSharedMemory.buf[:1 + size] as view:
+            try:
+                return ScoreOffset(view[1:], offset, prefixSize, view)
+            except Exception as e:
+                # the traceback would keep memoryviews on the shared memory alive, and then it can not be closed
+                error = e.with_traceback(None)
+    finally:
+        oSharedMemory.close()
+    raise error
+
+# the candidate offsets are scored concurrently by a thread pool (ARC4 releases the GIL) or a process pool (the input is put once in shared memory)
+# the first offset (in the order of offsets) that passes wins, like the sequential scan; when it is known, the scoring of the other offsets is cancelled or stopped
+def ScanOffsetParallel(view, prefixSize, oPool, offsets=SCAN_OFFSETS):
+    if isinstance(oPool, concurrent.futures.ProcessPoolExecutor):
+        oSharedMemory = multiprocessing.shared_memory.SharedMemory(create=True, size=1 + len(view))
+        stop = oSharedMemory.buf
+        stop[0] = 0
+        stop[1:1 + len(view)] = view
+        futures = [oPool.submit(ScoreOffsetShared, oSharedMemory.name, len(view), offset, prefixSize) for offset in offsets]
+    else:
+        oSharedMemory = None
+        stop = bytearray(1)
+        futures = [oPool.submit(ScoreOffset, view, offset, prefixSize, stop) for offset in offsets]
+    try:
+        for offset, oFuture in zip(offsets, futures):
+            if oFuture.result() < ENTROPY_THRESHOLD:
+                return offset
+        return None
+    finally:
+        stop[0] = 1
+        for oFuture in futures:
+            oFuture.cancel()
+        concurrent.futures.wait(futures)
+        if oSharedMemory != None:
+            del stop
+            oSharedMemory.close()
+            oSharedMemory.unlink()
+
+def DecryptOffset(view, offset):
+    decrypted = bytearray(max(0, len(view) - offset - 8))
+    with memoryview(decrypted) as decryptedView:
+        RC4DecryptInto(ARC4.new(view[offset:offset + 8]), view[offset + 8:], decryptedView)
+    return decrypted
+
+# classifiers of the decrypted prefix of a candidate: Classify returns True when the candidate is accepted
+# prefixSize: the number of decrypted bytes the classifier needs, None = what the search decrypts
+# minimumSize: samples shorter than this are not accepted (the IcedID scan uses 0)
+class cClassifierEntropy(object):
+
+    def __init__(self, threshold=ENTROPY_THRESHOLD, minimumSize=CLASSIFIER_MINIMUM_SIZE):
+        self.threshold = threshold
+        self.minimumSize = minimumSize
+        self.prefixSize = None
+
+    def Classify(self, data):
+        if len(data) < self.minimumSize:
+            return False
+        return CalculateByteStatistics(data=data)[1] < self.threshold
+
+class cClassifierHeader(object):
+
+    def __init__(self, header):
+        self.header = header
+        self.prefixSize = len(header)
+
+    def Classify(self, data):
+        return data[:len(self.header)] == self.header
+
+class cClassifierPrintable(object):
+
+    def __init__(self, ratio=0.9, minimumSize=CLASSIFIER_MINIMUM_SIZE):
+        self.ratio = ratio
+        self.minimumSize = minimumSize
+        self.prefixSize = None
+
+    def Classify(self, data):
+        if len(data) == 0 or len(data) < self.minimumSize:
+            return False
+        return len(data) - len(bytes(data).translate(None, PRINTABLE)) >= self.ratio * len(data)
+
+# search for RC4 encrypted data with the key embedded in the data
+# a candidate is an offset, a key length and a key position: the position of the key relative to the start of the ciphertext (negative: the key precedes the ciphertext)
+# the offset is the start of the key or of the ciphertext, whichever comes first; the ciphertext runs to the end of the data, or up to the key when the key follows it
+# IcedID: 8 byte key followed by the ciphertext (key position -8), offsets 0 to 15
+class cRC4KeySearch(object):
+
+    def __init__(self, keyLengths=[8], keyPositions=[-8], offsets=SCAN_OFFSETS, oClassifier=None, prefixSize=SCAN_PREFIX_SIZE):
+        self.keyLengths = keyLengths
+        self.keyPositions = keyPositions
+        self.offsets = offsets
+        self.oClassifier = cClassifierEntropy() if oClassifier == None else oClassifier
+        self.prefixSize = prefixSize
+
+    # breadth-first: at each offset, all key lengths and key positions are tried before the next offset
+    # yields [offset, key length, key position, key start, ciphertext start, ciphertext end]
+    def Candidates(self, size, offsets=None):
+        for offset in self.offsets if offsets == None else offsets:
+            for keyLength in self.keyLengths:
+                for keyPosition in self.keyPositions:
+                    if keyPosition < 0:
+                        keyStart = offset
+                        start = offset - keyPosition
+                        end = size
+                    else:
+                        keyStart = offset + keyPosition
+                        start = offset
+                        end = keyStart
+                    if offset < 0 or keyStart + keyLength > size:
+                        continue
+                    yield [offset, keyLength, keyPosition, keyStart, start, max(start, end)]
+
+    def PrefixSize(self):
+        sizes = [size for size in [self.prefixSize, self.oClassifier.prefixSize] if size != None]
+        return min(sizes) if sizes != [] else None
+
+    # two stages: each candidate is scored on a decrypted prefix, only the accepted candidate is decrypted in full (by continuing its RC4 stream)
+    # the candidates are memoryview windows on the input, and are decrypted into one reused buffer: memory use is about 2x the input, whatever the number of candidates
+    # the search stops at the first accepted candidate; offsets: the offsets in the order they are tried (default self.offsets)
+    # returns [candidate (dictionary with offset, keylength and keyposition), decrypted data] or [None, None]
+    def Search(self, dataArg, offsets=None):
+        prefixSize = self.PrefixSize()
+        with memoryview(dataArg) as view:
+            buffer = bytearray(len(view) if prefixSize == None else min(prefixSize, len(view)))
+            dCandidate = None
+            decrypted = None
+            with memoryview(buffer) as output:
+                for offset, keyLength, keyPosition, keyStart, start, end in self.Candidates(len(view), offsets):
+                    data = view[start:end]
+                    oRC4 = ARC4.new(view[keyStart:keyStart + keyLength])
+                    size = min(len(data), len(output))
+                    RC4DecryptInto(oRC4, data[:size], output[:size])
+                    if self.oClassifier.Classify(output[:size]):
+                        dCandidate = {'offset': offset, 'keylength': keyLength, 'keyposition': keyPosition}
+                        if size < len(data):
+                            decrypted = bytearray(len(data))
+                            with memoryview(decrypted) as decryptedView:
+                                decryptedView[:size] = output[:size]
+                                RC4DecryptInto(oRC4, data[size:], decryptedView[size:])
+                        break
+                data = None
+        if dCandidate == None:
+            return [None, None]
+        if decrypted == None:
+            # the buffer holds all decrypted data, shrunk in place
+            del buffer[size:]
+            decrypted = buffer
+        return [dCandidate, decrypted]
+
+# sequential: the IcedID configuration of cRC4KeySearch
+# oPool: optional thread or process pool to score the candidate offsets concurrently, see ScanOffsetParallel
+# offsets: the candidate offsets in the order they are tried, for example most successful first (cOffsetStatistics)
+def Scan(dataArg, prefixSize=SCAN_PREFIX_SIZE, oPool=None, offsets=SCAN_OFFSETS):
+    if oPool != None:
+        with memoryview(dataArg) as view:
+            offset = ScanOffsetParallel(view, prefixSize, oPool, offsets)
+            if offset == None:
+                return [None, None]
+            return [offset, DecryptOffset(view, offset)]
+    dCandidate, decrypted = cRC4KeySearch(oClassifier=cClassifierEntropy(minimumSize=0), prefixSize=prefixSize).Search(dataArg, offsets)
+    if dCandidate == None:
+        return [None, None]
+    return [dCandidate['offset'], decrypted]
+
+# result of the decryption: offset, header fields (None when not parsed or when the decrypted data is shorter than the header), size and SHA-256
+# the shellcode region is a memoryview on the decrypted data (not a copy), it is shorter than the shellcode size when the decrypted data is truncated
+class cResult(object):
+
+    def __init__(self, offset, decrypted, dCandidate=None, parseHeader=True):
+        self.offset = offset
+        self.decrypted = decrypted
+        self.dCandidate = dCandidate
+        self.header = None
+        self.sizedecrypted = None
+        self.entrypoint = None
+        self.shellcodesize = None
+        self.unknown = None
+        if offset != None and parseHeader and len(decrypted) >= HEADER_SIZE:
+            self.header, self.sizedecrypted, self.entrypoint, self.shellcodesize, self.unknown = struct.unpack_from('<IIIII', decrypted)
+
+    def Shellcode(self):
+        if self.shellcodesize == None:
+            return None
+        with memoryview(self.decrypted) as view:
+            return view[HEADER_SIZE:HEADER_SIZE + self.shellcodesize]
+
+    def SHA256(self):
+        return hashlib.sha256(self.decrypted).hexdigest()
+
+    def ShellcodeSHA256(self):
+        with self.Shellcode() as shellcode:
+            return hashlib.sha256(shellcode).hexdigest()
+
+    # the data is written from a memoryview, without a copy; shellcode: only the shellcode region (when there is a header)
+    def Carve(self, filename, shellcode=False):
+        with open(filename, 'wb') as fCarve:
+            if shellcode and self.shellcodesize != None:
+                with self.Shellcode() as view:
+                    fCarve.write(view)
+            else:
+                fCarve.write(self.decrypted)
+
+    def ToDict(self):
+        if self.offset == None:
+            return {'offset': None, 'error': 'Failed to decrypt'}
+        dResult = {'offset': self.offset}
+        if self.dCandidate != None:
+            dResult['keylength'] = self.dCandidate['keylength']
+            dResult['keyposition'] = self.dCandidate['keyposition']
+        if self.header != None:
+            dResult['header'] = self.header
+            dResult['sizedecrypted'] = self.sizedecrypted
+            dResult['entrypoint'] = self.entrypoint
+            dResult['shellcodesize'] = self.shellcodesize
+            dResult['unknown'] = self.unknown
+        dResult['size'] = len(self.decrypted)
+        dResult['sha256'] = self.SHA256()
+        if self.header != None:
+            dResult['shellcodesha256'] = self.ShellcodeSHA256()
+        return dResult
+
+    def ToText(self):
+        if self.offset == None:
+            return b'Failed to decrypt\n'
+        if self.header == None:
+            return b'Offset: %d Size decrypted: %d No header\n' % (self.offset, len(self.decrypted))
+        return b'Offset: %d Header: 0x%08x Size decrypted: %d Shellcode entrypoint: 0x%02x Shellcode size: %d Unknown: %d\n' % (self.offset, self.header, self.sizedecrypted, self.entrypoint, self.shellcodesize, self.unknown)
 
 def Check(data):
-    offset, decrypted = Scan(data)
-    if offset != None:
-        return b'Offset: %d Header: 0x%08x Size decrypted: %d Shellcode entrypoint: 0x%02x Shellcode size: %d Unknown: %d\n' % ((offset, ) + struct.unpack('<IIIII', decrypted[:4*5]))
-    return b'Failed to decrypt\n'
+    return cResult(*Scan(data)).ToText()
+
+# JSON output of Check, one object with the fields of cResult.ToDict
+def CheckJSON(data):
+    return json.dumps(cResult(*Scan(data)).ToDict())
 
 def Decrypt(data):
     offset, decrypted = Scan(data)
     if offset != None:
         return decrypted
     return b''
+
+# yields [chunk type, position of the chunk data, chunk data length] for each chunk of a PNG file in a buffer (bytes, mmap, ...), the chunk data is not copied
+def PNGChunks(data, checkCRC=False):
+    if data[:len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        raise Exception('No PNG signature')
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(data):
+        length, chunkType = struct.unpack_from('>I4s', data, position)
+        start = position + 8
+        if start + length + 4 > len(data):
+            raise Exception('Truncated %s chunk at 0x%08x' % (chunkType.decode('latin-1'), position))
+        if checkCRC:
+            with memoryview(data) as view:
+                crc = zlib.crc32(view[position + 4:start + length])
+            if crc != struct.unpack_from('>I', data, start + length)[0]:
+                raise Exception('CRC error %s chunk at 0x%08x' % (chunkType.decode('latin-1'), position))
+        yield [chunkType, start, length]
+        if chunkType == b'IEND':
+            break
+        position = start + length + 4
+
+# the IDAT chunk data concatenated into one preallocated bytearray
+def ExtractIDAT(data, checkCRC=False):
+    chunks = [[start, length] for chunkType, start, length in PNGChunks(data, checkCRC) if chunkType == b'IDAT']
+    idat = bytearray(sum([length for start, length in chunks]))
+    position = 0
+    with memoryview(data) as view:
+        for start, length in chunks:
+            idat[position:position + length] = view[start:start + length]
+            position += length
+    return idat
+
+# the whole file, for encrypted data that is not in a PNG file
+def ReadRaw(filename):
+    with open(filename, 'rb') as fRaw:
+        return fRaw.read()
+
+def ReadIDAT(filename, checkCRC=False):
+    with open(filename, 'rb') as fPNG:
+        if os.fstat(fPNG.fileno()).st_size == 0:
+            raise Exception('Empty file')
+        with mmap.mmap(fPNG.fileno(), 0, access=mmap.ACCESS_READ) as oMmap:
+            return ExtractIDAT(oMmap, checkCRC)
+
+def CheckFile(filename, checkCRC=False):
+    return Check(ReadIDAT(filename, checkCRC))
+
+def CheckFileJSON(filename, checkCRC=False):
+    return CheckJSON(ReadIDAT(filename, checkCRC))
+
+def DecryptFile(filename, checkCRC=False):
+    return Decrypt(ReadIDAT(filename, checkCRC))
+
+# arguments: files, glob patterns, directories (recursive) and @files with one argument per line
+def ExpandFilenameArguments(arguments):
+    filenames = []
+    for argument in arguments:
+        if argument.startswith('@'):
+            with open(argument[1:], 'r') as fList:
+                filenames.extend(ExpandFilenameArguments([line.strip() for line in fList if line.strip() != '']))
+        elif os.path.isdir(argument):
+            for root, directories, files in os.walk(argument):
+                directories.sort()
+                filenames.extend([os.path.join(root, filename) for filename in sorted(files)])
+        elif glob.has_magic(argument):
+            filenames.extend(sorted(glob.glob(argument)))
+        else:
+            filenames.append(argument)
+    return filenames
+
+# persistent statistics (JSON file) of the offsets that decrypted, per campaign; the candidate offsets are tried most successful first
+class cOffsetStatistics(object):
+
+    def __init__(self, filename='', campaign='global'):
+        self.filename = filename
+        self.campaign = campaign
+        self.dCampaigns = {}
+        self.hits = 0
+        self.misses = 0
+        self.candidates = 0
+        if self.filename != '' and os.path.exists(self.filename):
+            with open(self.filename, 'r') as fStatistics:
+                self.dCampaigns = {campaign: {int(offset): count for offset, count in dOffsets.items()} for campaign, dOffsets in json.load(fStatistics).get('campaigns', {}).items()}
+
+    def Order(self, offsets=SCAN_OFFSETS):
+        dOffsets = self.dCampaigns.get(self.campaign, {})
+        return sorted(offsets, key=lambda offset: (-dOffsets.get(offset, 0), offset))
+
+    # offsets: the order the offsets were tried in; a hit is a decryption with the first offset tried
+    def Record(self, offset, offsets):
+        dOffsets = self.dCampaigns.setdefault(self.campaign, {})
+        dOffsets[offset] = dOffsets.get(offset, 0) + 1
+        self.candidates += offsets.index(offset) + 1
+        if offset == offsets[0]:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def Save(self):
+        if self.filename == '':
+            return
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fStatistics:
+            json.dump({'campaigns': {campaign: {str(offset): count for offset, count in sorted(dOffsets.items())} for campaign, dOffsets in self.dCampaigns.items()}}, fStatistics)
+        os.replace(fStatistics.name, self.filename)
+
+    def Report(self):
+        decrypted = self.hits + self.misses
+        if decrypted == 0:
+            return 'Offsets: no decryptions'
+        return 'Offsets (%s): hit rate %.1f%% (%d/%d decrypted with the first offset tried), average candidates tried: %.2f' % (self.campaign, 100.0 * self.hits / decrypted, self.hits, decrypted, self.candidates / decrypted)
+
+oScanPool = None
+
+# threads > 0: the candidate offsets are scored by a thread pool, one per (worker) process
+def ScanPool(threads):
+    global oScanPool
+    if threads > 0 and oScanPool == None:
+        oScanPool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    return oScanPool
+
+# result of one file, one JSONL line: the fields of cResult.ToDict, with the decrypted data optionally carved to carveDirectory/<sha256>.bin (shellcode: only the shellcode region)
+# oSearch: search (cRC4KeySearch) for other payloads than IcedID PNGs, the IcedID header fields are then not reported; raw: the file is the encrypted data, not a PNG
+def ProcessFile(filename, checkCRC=False, carveDirectory='', prefixSize=SCAN_PREFIX_SIZE, threads=0, offsets=SCAN_OFFSETS, oSearch=None, raw=False, shellcode=False):
+    dResult = {'filename': filename}
+    try:
+        data = ReadRaw(filename) if raw else ReadIDAT(filename, checkCRC)
+        if oSearch == None:
+            oResult = cResult(*Scan(data, prefixSize, ScanPool(threads), offsets))
+        else:
+            dCandidate, decrypted = oSearch.Search(data, offsets)
+            oResult = cResult(None if dCandidate == None else dCandidate['offset'], decrypted, dCandidate, False)
+        data = None
+    except Exception as e:
+        dResult['error'] = str(e)
+        return dResult
+    dResult.update(oResult.ToDict())
+    if oResult.offset != None and carveDirectory != '':
+        carveSHA256 = dResult['shellcodesha256'] if shellcode and 'shellcodesha256' in dResult else dResult['sha256']
+        dResult['carved'] = os.path.join(carveDirectory, carveSHA256 + '.bin')
+        if not os.path.exists(dResult['carved']):
+            oResult.Carve(dResult['carved'], shellcode)
+    return dResult
+
+# with a process pool, the order of the offsets is taken from the statistics at the start; without, it is updated after each file
+def ProcessFiles(filenames, fOut, processes, ordered=True, checkCRC=False, carveDirectory='', prefixSize=SCAN_PREFIX_SIZE, threads=0, oOffsetStatistics=None, oSearch=None, raw=False, shellcode=False):
+    if carveDirectory != '':
+        os.makedirs(carveDirectory, exist_ok=True)
+    if oOffsetStatistics == None:
+        oOffsetStatistics = cOffsetStatistics()
+    counters = collections.Counter()
+    start = time.perf_counter()
+    searchOffsets = SCAN_OFFSETS if oSearch == None else oSearch.offsets
+    offsets = oOffsetStatistics.Order(searchOffsets)
+    Process = functools.partial(ProcessFile, checkCRC=checkCRC, carveDirectory=carveDirectory, prefixSize=prefixSize, threads=threads, oSearch=oSearch, raw=raw, shellcode=shellcode)
+
+    def Output(dResult, offsets):
+        counters['failed' if 'error' in dResult else 'decrypted'] += 1
+        if dResult.get('offset') != None:
+            oOffsetStatistics.Record(dResult['offset'], offsets)
+        fOut.write(json.dumps(dResult) + '\n')
+
+    if processes == 0:
+        for filename in filenames:
+            offsets = oOffsetStatistics.Order(searchOffsets)
+            Output(Process(filename, offsets=offsets), offsets)
+    else:
+        Process = functools.partial(Process, offsets=offsets)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as oPool:
+            if ordered:
+                for dResult in oPool.map(Process, filenames, chunksize=max(1, min(64, len(filenames) // (processes * 4)))):
+                    Output(dResult, offsets)
+            else:
+                futures = [oPool.submit(Process, filename) for filename in filenames]
+                for oFuture in concurrent.futures.as_completed(futures):
+                    Output(oFuture.result(), offsets)
+    duration = time.perf_counter() - start
+    print('Files: %d decrypted: %d failed: %d duration: %.3f s files/second: %.1f' % (len(filenames), counters['decrypted'], counters['failed'], duration, len(filenames) / duration if duration > 0 else 0.0), file=sys.stderr)
+    print(oOffsetStatistics.Report(), file=sys.stderr)
+    oOffsetStatistics.Save()
+    return counters
+
+def StatisticsParity():
+    inputs = [b'', b'A', b'AB', bytes(range(0x100)), bytes(range(0x100))[::-1] * 100, b'\x00' * 1000, b'\xFF\x00' * 5000, b'IcedID ' * 10000]
+    inputs += [os.urandom(size) for size in [2, 3, 15, 16, 17, 4095, 4096, 4097, STATISTICS_NUMPY_MINIMUM - 1, STATISTICS_NUMPY_MINIMUM, STATISTICS_NUMPY_CHUNK + 3]]
+    inputs += [bytes([byte % 0x60 for byte in os.urandom(size)]) for size in [100, 10000, 100000]]
+    mismatches = 0
+    for data in inputs:
+        reference = CalculateByteStatistics(data=data, reference=True)
+        results = [CalculateByteStatistics(data=data)]
+        for useNumPy in [False, True]:
+            dPrevalence, averageConsecutiveByteDifference = CountBytes(data, useNumPy)
+            results.append(CalculateByteStatistics(dPrevalence=dPrevalence)[:-1] + (averageConsecutiveByteDifference, ))
+        for result in results:
+            if result != reference:
+                mismatches += 1
+                print('Mismatch for %d bytes: %s != %s' % (len(data), result, reference))
+    print('Parity: %d inputs, %d mismatches (NumPy %s)' % (len(inputs), mismatches, 'available' if numpy != None else 'not available'))
+    return mismatches == 0
+
+def StatisticsBenchmark(sizes):
+    for size in sizes:
+        data = os.urandom(size * 0x100000)
+        functions = [['reference', lambda: CountBytesReference(data)], ['counter', lambda: CountBytes(data, useNumPy=False)]]
+        if numpy != None:
+            functions.append(['numpy', lambda: CountBytes(data)])
+        durations = {}
+        for name, function in functions:
+            start = time.perf_counter()
+            function()
+            durations[name] = time.perf_counter() - start
+        print('%3d MB ' % size + ' '.join(['%s: %.3f s (%.1fx)' % (name, durations[name], durations['reference'] / durations[name]) for name, function in functions]))
+
+# random bytes, followed by an RC4 key and the encrypted header + low entropy shellcode; offset 15 is the worst case for Scan
+def SimulatedPayload(size, offset=15):
+    shellcode = (b'\x55\x8B\xEC\x83\xEC\x10\x53\x56\x57\x8B\x7D\x08\x33\xF6\x90\xC3' * (size // 16 + 1))[:max(0, size - 4*5)]
+    key = os.urandom(8)
+    return os.urandom(offset) + key + ARC4.new(key).encrypt(struct.pack('<IIIII', 0x0A0B0C0D, len(shellcode) + 4*5, 0x40, len(shellcode), 0) + shellcode)
+
+# peak of the memory allocated by Scan, relative to the input size; reference is the previous implementation, that slices (copies) the input for each candidate offset
+def MemoryBenchmark(sizes):
+
+    def ScanReference(dataArg, prefixSize):
+        for offset in range(16):
+            data = dataArg[offset:]
+            key = data[:8]
+            data = data[8:]
+            oRC4 = ARC4.new(key)
+            if prefixSize == None:
+                decrypted = oRC4.decrypt(data)
+            else:
+                decrypted = oRC4.decrypt(data[:prefixSize])
+            result = CalculateByteStatistics(data=decrypted)
+            if result[1] < ENTROPY_THRESHOLD:
+                if prefixSize != None and len(data) > prefixSize:
+                    decrypted += oRC4.decrypt(data[prefixSize:])
+                return [offset, decrypted]
+        return [None, None]
+
+    for size in sizes:
+        data = SimulatedPayload(size * 0x100000)
+        for name, function, prefixSize in [['reference prefix', ScanReference, SCAN_PREFIX_SIZE], ['scan prefix', Scan, SCAN_PREFIX_SIZE], ['reference full', ScanReference, None], ['scan full', Scan, None]]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            offset, decrypted = function(data, prefixSize)
+            duration = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del decrypted
+            print('%3d MB %-16s offset: %s peak: %.1f MB (%.2fx input) duration: %.3f s' % (size, name, offset, peak / 0x100000, peak / len(data), duration))
+
+# worst case for the sequential scan: full scoring (no prefix) and the payload at offset 15
+def ParallelBenchmark(sizes, workers):
+    oThreadPool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    oProcessPool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        for size in sizes:
+            data = SimulatedPayload(size * 0x100000)
+            durations = {}
+            for name, oPool in [['sequential', None], ['threads', oThreadPool], ['processes', oProcessPool]]:
+                start = time.perf_counter()
+                offset, decrypted = Scan(data, None, oPool)
+                durations[name] = time.perf_counter() - start
+                del decrypted
+            print('%3d MB workers: %d offset: %d ' % (size, workers, offset) + ' '.join(['%s: %.3f s (%.2fx)' % (name, duration, durations['sequential'] / duration) for name, duration in durations.items()]))
+    finally:
+        oThreadPool.shutdown()
+        oProcessPool.shutdown()
+
+# comma separated integers and ranges (inclusive, for example 0-15 or -12--8), decimal or hexadecimal (0x)
+def ParseIntegers(argument):
+    integers = []
+    for item in argument.split(','):
+        oMatch = re.match(r'^(-?(?:0x[0-9a-f]+|\d+))(?:-(-?(?:0x[0-9a-f]+|\d+)))?$', item.strip(), re.I)
+        if oMatch == None:
+            raise Exception('Invalid integer or range: %s' % item)
+        start = int(oMatch.group(1), 0)
+        end = start if oMatch.group(2) == None else int(oMatch.group(2), 0)
+        integers.extend(range(start, end + 1))
+    return integers
+
+# entropy[:threshold[:minimum size]] header:hexadecimal printable[:ratio[:minimum size]]
+def ParseClassifier(argument):
+    name, _, value = argument.partition(':')
+    value, _, minimumSize = value.partition(':')
+    minimumSize = CLASSIFIER_MINIMUM_SIZE if minimumSize == '' else int(minimumSize, 0)
+    if name == 'entropy':
+        return cClassifierEntropy(ENTROPY_THRESHOLD if value == '' else float(value), minimumSize)
+    elif name == 'header' and value != '':
+        return cClassifierHeader(bytes.fromhex(value))
+    elif name == 'printable':
+        return cClassifierPrintable(0.9 if value == '' else float(value), minimumSize)
+    raise Exception('Invalid classifier: %s' % argument)
+
+def Main():
+    oParser = optparse.OptionParser(usage='usage: %prog [options] [@]file|glob|directory ...\n       %prog [options] parity\n       %prog [options] benchmark\n       %prog [options] memorybenchmark\n       %prog [options] parallelbenchmark\ndecrypt IcedID PNG IDATs\nFor each PNG file, a JSONL line is written with the offset, the header fields and the SHA-256 of the decrypted data and of the shellcode\nOther payloads with an embedded RC4 key: --raw, --keylengths, --keypositions, --offsets and --classifier, for example: --raw --keylengths 16 --keypositions -16 --offsets 0-64 --classifier header:4d5a\nparity compares the byte statistics with the reference implementation, benchmark times them on random data, memorybenchmark measures the memory used by Scan (tracemalloc), parallelbenchmark compares sequential and concurrent scoring of the offsets (-p workers)')
+    oParser.add_option('-p', '--processes', type=int, default=os.cpu_count(), help='Number of worker processes, 0 = no pool (default %d)' % os.cpu_count())
+    oParser.add_option('-u', '--unordered', action='store_true', default=False, help='Output results as they complete, instead of in the order of the files')
+    oParser.add_option('-o', '--output', type=str, default='', help='Output JSONL file (default stdout)')
+    oParser.add_option('-c', '--carve', type=str, default='', help='Directory to write the decrypted data to, as <sha256>.bin')
+    oParser.add_option('--shellcode', action='store_true', default=False, help='Carve only the shellcode region of the decrypted data, as <shellcodesha256>.bin')
+    oParser.add_option('--prefix', type=int, default=SCAN_PREFIX_SIZE, help='Number of decrypted bytes scored per candidate offset, 0 = all (default %d)' % SCAN_PREFIX_SIZE)
+    oParser.add_option('-t', '--threads', type=int, default=0, help='Number of threads per process to score the candidate offsets concurrently, for large IcedID payloads (default 0)')
+    oParser.add_option('--statistics', type=str, default='', help='JSON file with the statistics of the decrypted offsets, to try the most successful offsets first (updated after the run)')
+    oParser.add_option('--campaign', type=str, default='global', help='Campaign name for the offset statistics (default global)')
+    oParser.add_option('--keylengths', type=str, default='', help='RC4 key lengths to search, for example 5-16 (default 8)')
+    oParser.add_option('--keypositions', type=str, default='', help='Positions of the key relative to the start of the ciphertext, negative = before (default -8)')
+    oParser.add_option('--offsets', type=str, default='', help='Offsets to search (default 0-15)')
+    oParser.add_option('--classifier', type=str, default='', help='Classifier of the decrypted data: entropy[:threshold[:minimum size]], header:hexadecimal or printable[:ratio[:minimum size]] (default entropy:%s:%d)' % (ENTROPY_THRESHOLD, CLASSIFIER_MINIMUM_SIZE))
+    oParser.add_option('--raw', action='store_true', default=False, help='The files are the encrypted data, not PNG files')
+    oParser.add_option('--crc', action='store_true', default=False, help='Check the CRC of the PNG chunks')
+    oParser.add_option('-s', '--sizes', type=str, default='1,10,50', help='Sizes in MB of the benchmark data (default 1,10,50)')
+    (options, args) = oParser.parse_args()
+
+    if len(args) == 1 and args[0] == 'parity':
+        if not StatisticsParity():
+            sys.exit(1)
+    elif len(args) == 1 and args[0] == 'benchmark':
+        StatisticsBenchmark([int(size) for size in options.sizes.split(',')])
+    elif len(args) == 1 and args[0] == 'memorybenchmark':
+        MemoryBenchmark([int(size) for size in options.sizes.split(',')])
+    elif len(args) == 1 and args[0] == 'parallelbenchmark':
+        ParallelBenchmark([int(size) for size in options.sizes.split(',')], max(1, options.processes))
+    elif len(args) > 0:
+        filenames = ExpandFilenameArguments(args)
+        oOffsetStatistics = cOffsetStatistics(options.statistics, options.campaign)
+        oSearch = None
+        if options.keylengths != '' or options.keypositions != '' or options.offsets != '' or options.classifier != '' or options.raw:
+            oSearch = cRC4KeySearch(ParseIntegers(options.keylengths) if options.keylengths != '' else [8], ParseIntegers(options.keypositions) if options.keypositions != '' else [-8], ParseIntegers(options.offsets) if options.offsets != '' else SCAN_OFFSETS, ParseClassifier(options.classifier) if options.classifier != '' else None, options.prefix if options.prefix > 0 else None)
+        if options.output == '':
+            ProcessFiles(filenames, sys.stdout, options.processes, not options.unordered, options.crc, options.carve, options.prefix if options.prefix > 0 else None, options.threads, oOffsetStatistics, oSearch, options.raw, options.shellcode)
+        else:
+            with open(options.output, 'w') as fOut:
+                ProcessFiles(filenames, fOut, options.processes, not options.unordered, options.crc, options.carve, options.prefix if options.prefix > 0 else None, options.threads, oOffsetStatistics, oSearch, options.raw, options.shellcode)
+    else:
+        oParser.print_help()
+
+if __name__ == '__main__':
+    Main()